@@ -1,26 +1,41 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
+import json
 import os
 import logging
 import logging.config
 import re
+import requests
 import sys
 import subprocess
+import threading
+import time
 import yaml
 from datetime import datetime, timedelta
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("--archive",  dest="archive", action="store", default="/opt/couchbase/var/lib/couchbase/backups", help="The archive directory used to store backup data")
 parser.add_argument("--cbbackupmgr",  dest="cbbackupmgr", action="store", default="/opt/couchbase/bin/cbbackupmgr", help="The backup manager executable")
+parser.add_argument("--compact-budget",  dest="compact_budget", action="store", type=float, default=3600, help="The seconds compaction may take per run, backups expected to take longer to compact wait for the next run")
 parser.add_argument("--config",  dest="config", action="store", help="The path to YAML config file, reading config file overrides args default values")
 parser.add_argument("--cluster",  dest="cluster", action="store", default="localhost", help="The hostname of the Couchbase cluster")
 parser.add_argument("--create",  dest="create", action="store_true", default=False, help="Create archvie and repo if they don't exist")
+parser.add_argument("--dry-run",  dest="dry_run", action="store_true", default=False, help="Print the merge plan and exit")
 parser.add_argument("--dump",  dest="dump", action="store_true", default=False, help="Dump the configuration values")
 parser.add_argument("--file",  dest="file", action="store", help="The file to write results to")
 parser.add_argument("--format",  dest="format", action="store", default="{host}:{action}:{status}", help="The format in which to print results. The str of str.format()")
+parser.add_argument("--history",  dest="history", action="store", help="The file to record the throughput of backups to, the thread count is tuned from it when set")
 parser.add_argument("--keep",  dest="keep", action="store", type=int, default=3, help="The number of backups to keep")
+parser.add_argument("--port",  dest="port", action="store", type=int, choices=[8091, 18091], default=8091, help="The port of the Couchbase cluster, used to list buckets")
 parser.add_argument("--purge",  dest="purge", action="store_true", default=False, help="If the last backup failed before it finished then delete the last backup and backup from the last successful backup")
+parser.add_argument("--ledger",  dest="ledger", action="store", default="{archive}/{repo}.compaction.json", help="The file to record the compacted backups of a repo to, {archive} and {repo} are replaced")
+parser.add_argument("--max-threads",  dest="max_threads", action="store", type=int, default=16, help="The most threads a tuned backup uses")
+parser.add_argument("--merge-duration",  dest="merge_duration", action="store", type=float, help="The estimated seconds a merge may take, larger merges are split into several merges")
+parser.add_argument("--merge-rate",  dest="merge_rate", action="store", type=float, default=100, help="The MiB/s merges are estimated to rewrite backups at")
+parser.add_argument("--min-threads",  dest="min_threads", action="store", type=int, default=1, help="The least threads a tuned backup uses")
+parser.add_argument("--parallel",  dest="parallel", action="store", type=int, default=0, help="The number of buckets to backup concurrently, each bucket to its own archive under the archive directory. 0 backs up all buckets together")
 parser.add_argument("--password",  dest="password", action="store", default="secret", help="The password of the Couchbase cluster")
 parser.add_argument("--repo",  dest="repo", action="store", default="local", help="The name of the backup repository to backup data to")
 parser.add_argument("--schedule",  dest="schedule", action="append", default=[], choices=["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"], help="The day(s) of the week to perform merge operation, option may be called multiple times. i.e. --merge Sunday --merge Monday")
@@ -32,6 +47,7 @@ args = parser.parse_args()
 # return results of args and config file, if passed
 def get_config():
     config = vars(args)
+    config.update(get_timeouts())
     config.update(get_logging_config())
 
     if config["config"]:
@@ -75,6 +91,128 @@ def get_logging_config():
     return {"logging": config}
 
 
+# return the seconds each cbbackupmgr action may run before it is terminated, null doesn't limit the action
+def get_timeouts():
+    timeouts = {
+        "backup": None,
+        "compact": None,
+        "config": None,
+        "merge": None
+    }
+
+    return {"timeouts": timeouts}
+
+
+# the results of each cbbackupmgr command, reported along with the final status
+results = []
+start_time = time.time()
+
+# the seconds a terminated command is given to exit before it is killed
+terminate_wait = 30
+
+# the backups compacted per run while there is no compaction rate to estimate the
+# time of a compaction from, the first compaction of a repo gives the rate
+unrated_compactions = 1
+
+# cbbackupmgr reports transfers like: Copied all data in 1m2s (Avg. 21.31MiB/Sec) 31591 items / 1.15GiB
+rate_regex = re.compile("Avg\. ([\d.]+)([KMG]?i?B)/Sec")
+items_regex = re.compile("(\d+) items")
+rate_units = {"B": 1.0 / 1024 ** 2, "KB": 1.0 / 1024, "KiB": 1.0 / 1024, "MB": 1, "MiB": 1, "GB": 1024, "GiB": 1024}
+
+
+# raised when a cbbackupmgr command fails or times out, or the repo can't be read
+class CommandError(Exception):
+    pass
+
+
+# log the lines of a command's output as they are written, collecting the
+# transfer rate in MiB/s and the number of items copied
+def read_stream(stream, level, metrics):
+    for line in iter(stream.readline, ""):
+        line = line.rstrip()
+        if not line:
+            continue
+
+        logging.log(level, line)
+
+        match = rate_regex.search(line)
+        if match:
+            metrics["rate"] = round(float(match.group(1)) * rate_units.get(match.group(2), 1), 2)
+
+        match = items_regex.search(line)
+        if match:
+            metrics["items"] = metrics.get("items", 0) + int(match.group(1))
+
+    stream.close()
+
+
+# run a cbbackupmgr command, streaming stdout and stderr to the log. the command
+# is terminated when it runs longer than the timeout of its action, the duration
+# and metrics of the command are added to the results and failure raises CommandError.
+# returns the result of the command
+def run_command(config, action, cmd):
+    name = get_action(config, "cbbackupmgr {}".format(action))
+    timeout = (config["timeouts"] or {}).get(action)
+    metrics = {}
+    timed_out = False
+
+    logging.debug("executing command: {}".format(str(cmd)))
+    start = time.time()
+    sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, bufsize=1)
+
+    readers = [
+        threading.Thread(target=read_stream, args=(sp.stdout, logging.INFO, metrics)),
+        threading.Thread(target=read_stream, args=(sp.stderr, logging.WARNING, metrics))
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    try:
+        sp.wait(timeout)
+    except subprocess.TimeoutExpired:
+        logging.error("{} exceeded timeout of {} seconds, terminating".format(name, timeout))
+        timed_out = True
+        sp.terminate()
+        try:
+            sp.wait(terminate_wait)
+        except subprocess.TimeoutExpired:
+            logging.error("{} did not exit after {} seconds, killing".format(name, terminate_wait))
+            sp.kill()
+            sp.wait()
+
+    for reader in readers:
+        reader.join(terminate_wait)
+
+    duration = time.time() - start
+    status = "CRITICAL" if timed_out or sp.returncode != 0 else "OK"
+    logging.info("{} finished with return code {} in {:.1f} seconds: {}".format(name, sp.returncode, duration, metrics))
+    result = get_result(config, name, status, duration, **metrics)
+    results.append(result)
+
+    if status == "CRITICAL":
+        raise CommandError(name)
+
+    return result
+
+
+# return the name of an action, with the bucket group it runs for in parallel mode
+def get_action(config, action):
+    if config.get("group"):
+        return "{} {}".format(action, config["group"])
+
+    return action
+
+
+# return a result row, every format variable has a value
+def get_result(config, action, status, duration, rate="", items="", size="", threads=""):
+    return {"host": config["cluster"], "action": action, "status": status, "duration": round(duration, 1), "rate": rate, "items": items, "size": size, "threads": threads}
+
+
+# backup names look like 2018-01-01T00_00_00.000000000-06_00
+backup_regex = "(\d{4})-(\d{2})-(\d{2})T(\d{2})_(\d{2})_(\d{2})(\S+)$"
+
+
 # return the name of the weekday
 def weekday(number):
     wd = {
@@ -90,30 +228,110 @@ def weekday(number):
     return wd.get(number)
 
 
+# return the size in bytes of the files under path
+def get_dir_size(path):
+    size = 0
+
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            size += get_dir_size(entry.path)
+        else:
+            size += entry.stat(follow_symlinks=False).st_size
+
+    return size
+
+
+# return the name of the bucket a backup bucket directory holds, the directory
+# is named {bucket}-{uuid} and bucket-config.json has the name as well
+def get_bucket_name(path):
+    try:
+        with open(os.path.join(path, "bucket-config.json"), "r") as f:
+            return json.load(f)["name"]
+    except (IOError, ValueError, KeyError):
+        return re.sub("-[0-9a-f]{32}$", "", os.path.basename(path))
+
+
+# return the timestamp of a backup name, 2018-01-01T00_00_00.000000000-06_00
+def get_backup_time(name):
+    match = re.match(backup_regex, name)
+    timestamp = datetime(*[int(x) for x in match.groups()[:6]])
+
+    # the utc offset follows the fractional seconds
+    offset = re.search("([+-])(\d{2})_(\d{2})$", name)
+    if offset:
+        sign = -1 if offset.group(1) == "-" else 1
+        timestamp -= sign * timedelta(hours=int(offset.group(2)), minutes=int(offset.group(3)))
+
+    return timestamp
+
+
+# scan the repo directory and return its backups oldest first, without spawning
+# cbbackupmgr. each backup has a name and utc timestamp, with sizes the size in
+# bytes and the size of each bucket are added by walking the backup's files.
+def inspect_repo(config, sizes=False):
+    backups = []
+
+    for entry in os.scandir(os.path.join(config["archive"], config["repo"])):
+        if not re.match(backup_regex, entry.name) or not entry.is_dir():
+            continue
+
+        backup = {"name": entry.name, "timestamp": get_backup_time(entry.name)}
+
+        if sizes:
+            backup["buckets"] = dict((get_bucket_name(bucket.path), get_dir_size(bucket.path)) for bucket in os.scandir(entry.path) if bucket.is_dir())
+            backup["size"] = sum(backup["buckets"].values())
+
+        backups.append(backup)
+
+    # backups within the same second are ordered by the fractional seconds of the name
+    backups.sort(key=lambda x: (x["timestamp"], x["name"]))
+    return backups
+
+
 # retrive the list of backups
 def get_backup_list(config):
-    regex = "(\d{4})-(\d{2})-(\d{2})T(\d{2})_(\d{2})_(\d{2})(\S+)"
+    try:
+        return [x["name"] for x in inspect_repo(config)]
+    except OSError as e:
+        logging.error("unable to read repo: {}".format(str(e)))
+        action = get_action(config, "inspect repo")
+        results.append(get_result(config, action, "CRITICAL", 0))
+        raise CommandError(action)
 
-    cmd =  [
-        config["cbbackupmgr"], "list", 
-        "-a", config["archive"], 
-        "-r", config["repo"]
-    ]
 
-    logging.debug("executing command: {}".format(str(cmd)))
-    sp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    stdout, stderr = sp.communicate()
-    
-    if sp.returncode > 0:
-        logging.error(stdout)
-        send_exit(config, action="cbbackupmgr list", error=True)
+# return the stamp of the repo directory, adding or removing a backup directory
+# changes its mtime and link count
+def get_repo_stamp(config):
+    try:
+        stat = os.stat(os.path.join(config["archive"], config["repo"]))
+        return [stat.st_mtime_ns, stat.st_nlink]
+    except OSError:
+        return None
+
+
+# return the backups of the repo state, the repo is only listed again when the
+# repo directory changed since the state was last updated
+def get_backups(config, state):
+    stamp = get_repo_stamp(config)
+
+    if "backups" not in state or stamp is None or stamp != state["stamp"]:
+        logging.debug("listing backups, repo stamp {} differs from {}".format(stamp, state.get("stamp")))
+        state["backups"] = get_backup_list(config)
+        state["stamp"] = get_repo_stamp(config)
+
+    return state["backups"]
 
-    # generate backup list
-    return [x.group(0) for x in re.finditer(regex, stdout)]
+
+# record a change this process made to the repo in the repo state
+def update_repo_state(config, state, backups):
+    state["backups"] = backups
+    state["stamp"] = get_repo_stamp(config)
+    logging.debug("updated backup list: {}".format(backups))
 
 
 # initiate the backup of cluster
-def backup(config, backups):
+def backup(config, state):
+    backups = get_backups(config, state)
     logging.info("current backup list: {}".format(backups))
     logging.info("initiating backup against cluster: {}".format(config["cluster"]))
         
@@ -131,15 +349,17 @@ def backup(config, backups):
     if config["purge"] is True:
         cmd.extend(["--purge"])
 
-    logging.debug("executing command: {}".format(str(cmd)))
-    sp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    stdout, stderr = sp.communicate()
-    
-    if sp.returncode > 0:
-        logging.error(stdout)
-        send_exit(config, action="cbbackupmgr backup", error=True)
-    else:
-        logging.info(stdout)
+    result = run_command(config, "backup", cmd)
+
+    # the repo is listed again as --purge may have removed the last backup, the
+    # new backup is the backup directory that wasn't in the list before
+    listed = get_backup_list(config)
+    new_backups = [x for x in listed if x not in backups]
+    update_repo_state(config, state, listed)
+
+    # the archive grew by the size of the new backup
+    result["size"] = sum(get_dir_size(os.path.join(config["archive"], config["repo"], x)) for x in new_backups)
+    result["threads"] = config["threads"]
 
 
 # create the archive and repo
@@ -153,85 +373,365 @@ def create(config):
             "-r", config["repo"]
         ]
 
-        logging.debug("executing command: {}".format(str(cmd)))
-        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        stdout, stderr = sp.communicate()
-        
-        if sp.returncode > 0:
-            logging.error(stdout)
-            send_exit(config, action="cbbackupmgr config", error=True)
-        else:
-            logging.info(stdout)
+        if config.get("include_buckets"):
+            cmd.extend(["--include-buckets", ",".join(config["include_buckets"])])
 
+        run_command(config, "config", cmd)
 
-# compact the backups
-def compact(config, backups):
-    if len(backups) > 0:
-        logging.info("current backup list: {}".format(backups))
-        
-        # retrieve the last backup from list
-        end = backups[-1]
 
-        logging.info("initiating backup compaction of {}".format(end))
-        
+# return the path of the compaction ledger of the repo
+def get_ledger_path(config):
+    return config["ledger"].format(archive=config["archive"], repo=config["repo"])
+
+
+# return the compaction ledger of the repo, the backups compacted so far by name
+# with their size before and after compaction
+def load_ledger(config):
+    try:
+        with open(get_ledger_path(config), "r") as f:
+            return json.load(f)
+    except IOError:
+        return {}
+    except ValueError:
+        logging.warning("ignoring invalid compaction ledger {}".format(get_ledger_path(config)))
+        return {}
+
+
+# write the compaction ledger of the repo
+def save_ledger(config, ledger):
+    path = get_ledger_path(config)
+
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump(ledger, f, indent=2, sort_keys=True)
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError) as e:
+        logging.error("unable to write compaction ledger: {}".format(str(e)))
+
+
+# return the bytes per second previous compactions of the repo ran at
+def get_compaction_rate(ledger):
+    size = sum(x["before"] for x in ledger.values() if x.get("duration"))
+    duration = sum(x["duration"] for x in ledger.values() if x.get("duration"))
+
+    return size / duration if duration else None
+
+
+# compact the backups that aren't in the compaction ledger yet, newest first. with
+# a compact_budget a compaction is only started when it's expected to finish within
+# the budget at the rate of previous compactions, the rest wait for the next run.
+# without a rate only unrated_compactions backups are compacted
+def compact(config, state):
+    backups = get_backups(config, state)
+    ledger = load_ledger(config)
+
+    # backups merged or removed since don't need their entries
+    pruned = dict((name, x) for name, x in ledger.items() if name in backups)
+    pending = [x for x in reversed(backups) if x not in ledger]
+    logging.info("current backup list: {}".format(backups))
+    logging.info("backups to compact: {}".format(pending))
+
+    start = time.time()
+    reclaimed = 0
+    unrated = 0
+
+    for name in pending:
+        path = os.path.join(config["archive"], config["repo"], name)
+        before = get_dir_size(path)
+
+        if config["compact_budget"]:
+            remaining = config["compact_budget"] - (time.time() - start)
+            rate = get_compaction_rate(pruned)
+            expected = before / rate if rate else 0
+
+            if remaining <= 0 or expected > remaining:
+                logging.info("not compacting {}, expected to take {:.0f} of the {:.0f} seconds left".format(name, expected, max(remaining, 0)))
+                continue
+
+            if rate is None:
+                if unrated >= unrated_compactions:
+                    logging.info("not compacting {}, no compaction rate yet".format(name))
+                    continue
+                unrated += 1
+
+        logging.info("initiating backup compaction of {}".format(name))
+
         cmd =  [
             config["cbbackupmgr"], "compact", 
             "-a", config["archive"], 
             "-r", config["repo"],
-            "--backup", end
+            "--backup", name
         ]
 
-        logging.debug("executing command: {}".format(str(cmd)))
-        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        stdout, stderr = sp.communicate()
-        
-        if sp.returncode > 0:
-            logging.error(stdout)
-            send_exit(config, action="cbbackupmgr compact", error=True)
-        else:
-            logging.info(stdout)
+        result = run_command(config, "compact", cmd)
+
+        after = get_dir_size(path)
+        reclaimed += before - after
+        pruned[name] = {"compacted": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"), "before": before, "after": after, "duration": result["duration"]}
+        save_ledger(config, pruned)
 
+    if pending or len(pruned) != len(ledger):
+        save_ledger(config, pruned)
 
-# merge the backups
-def merge(config, backups):
+    if pending:
+        logging.info("compaction reclaimed {} bytes".format(reclaimed))
+        results.append(get_result(config, get_action(config, "compaction"), "OK", time.time() - start, size=reclaimed))
+
+    # compaction rewrites the backups in place, the list is unchanged
+    update_repo_state(config, state, backups)
+
+
+# return the merges that bring the repo down to keep backups rewriting the fewest
+# bytes. of the runs of len-keep+1 consecutive backups the smallest is merged, split
+# into merges expected to take at most merge_duration seconds at merge_rate MiB/s
+def plan_merges(config):
+    backups = inspect_repo(config, sizes=True)
+    count = len(backups) - config["keep"] + 1
+    if count < 2:
+        return []
+
+    windows = [backups[i:i + count] for i in range(len(backups) - count + 1)]
+    window = min(windows, key=lambda x: sum(y["size"] for y in x))
+
+    rate = config["merge_rate"] * 1024 ** 2
+    limit = config["merge_duration"] * rate if config["merge_duration"] else None
+    chunks = [[]]
+
+    for backup in window:
+        chunk = chunks[-1]
+        if limit and len(chunk) > 1 and sum(x["size"] for x in chunk) + backup["size"] > limit:
+            chunks.append([])
+        chunks[-1].append(backup)
+
+    # a single backup left over doesn't need a merge
+    merges = []
+    for chunk in chunks:
+        if len(chunk) > 1:
+            size = sum(x["size"] for x in chunk)
+            merges.append({"start": chunk[0]["name"], "end": chunk[-1]["name"], "backups": [x["name"] for x in chunk], "size": size, "duration": size / rate})
+
+    return merges
+
+
+# print the merge plan of the repo
+def print_plan(config):
+    try:
+        plans = plan_merges(config)
+    except OSError as e:
+        print("{}: unable to read repo: {}".format(get_action(config, config["repo"]), str(e)))
+        return
+
+    for plan in plans:
+        print("{}: merge {} backups from {} to {}, {} bytes to rewrite, estimated {:.0f} seconds".format(get_action(config, config["repo"]), len(plan["backups"]), plan["start"], plan["end"], plan["size"], plan["duration"]))
+
+
+# merge the backups per the merge plan
+def merge(config, state):
+    backups = get_backups(config, state)
     if len(backups) > config["keep"] and weekday(datetime.today().weekday()) in config["schedule"]:
         logging.info("current backup list: {}".format(backups))
         logging.info("initiating backup merge per keep: {} and schedule: {}".format(config["keep"], config["schedule"]))
-        
-        start = backups[0]
-        end = backups[(len(backups)-config["keep"])]
 
-        logging.info("merging backups {} and {}".format(start, end))
+        for plan in plan_merges(config):
+            logging.info("merging backups {} and {}, {} bytes to rewrite, estimated {:.0f} seconds".format(plan["start"], plan["end"], plan["size"], plan["duration"]))
 
-        cmd =  [
-            config["cbbackupmgr"], "merge", 
-            "-a", config["archive"], 
-            "-r", config["repo"],
-            "--start", start,
-            "--end", end
-        ]
+            cmd =  [
+                config["cbbackupmgr"], "merge", 
+                "-a", config["archive"], 
+                "-r", config["repo"],
+                "--start", plan["start"],
+                "--end", plan["end"]
+            ]
 
-        logging.debug("executing command: {}".format(str(cmd)))
-        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        stdout, stderr = sp.communicate()
-        
-        if sp.returncode > 0:
-            logging.error(stdout)
-            send_exit(config, action="cbbackupmgr merge", error=True)
-        else:
-            logging.info(stdout)
+            run_command(config, "merge", cmd)
+
+            # the merged backup is written anew and is compacted again
+            ledger = load_ledger(config)
+            if ledger:
+                save_ledger(config, dict((name, x) for name, x in ledger.items() if name not in plan["backups"]))
+
+            # the merged range collapses into a single backup named after its end
+            backups = [x for x in backups if x not in plan["backups"][:-1]]
+            update_repo_state(config, state, backups)
+
+        if len(backups) > config["keep"]:
+            logging.info("{} backups left after merging, the rest are merged by the next runs".format(len(backups)))
     else:
         logging.info("current backup list: {}".format(backups))
         logging.info("no backup merge per keep: {} and schedule: {}".format(config["keep"], config["schedule"]))
 
 
+# return the buckets of the cluster with their disk usage in bytes, largest first
+def get_buckets(config):
+    protocol = "https" if config["port"] == 18091 else "http"
+    host = re.sub("^\w+://", "", config["cluster"]).split(":")[0]
+    url = "{}://{}:{}/pools/default/buckets?skipMap=true".format(protocol, host, config["port"])
+    logging.debug("listing buckets: {}".format(url))
+
+    try:
+        f = requests.get(url, auth=(config["username"], config["password"]), verify=False, timeout=30)
+        f.raise_for_status()
+        buckets = [(x["name"], x.get("basicStats", {}).get("diskUsed", 0)) for x in f.json()]
+    except Exception as e:
+        logging.error("unable to list buckets: {}".format(str(e)))
+        send_exit(config, action="list buckets", error=True)
+
+    buckets.sort(key=lambda x: x[1], reverse=True)
+    logging.info("cluster buckets by disk used: {}".format(buckets))
+    return buckets
+
+
+# return the bucket groups to backup largest first as (name, buckets, size), the
+# buckets of a group in bucket_groups are backed up together and every other
+# bucket on its own
+def get_bucket_groups(config, buckets):
+    sizes = dict(buckets)
+    groups = []
+    grouped = set()
+
+    for name, members in (config.get("bucket_groups") or {}).items():
+        members = [x for x in members if x in sizes]
+        if members:
+            groups.append((name, members, sum(sizes[x] for x in members)))
+            grouped.update(members)
+
+    groups.extend((name, [name], size) for name, size in buckets if name not in grouped)
+    groups.sort(key=lambda x: x[2], reverse=True)
+    return groups
+
+
+# backup, compact and merge a bucket group in its own archive, cbbackupmgr locks
+# the archive so concurrent backups can't share one. returns whether it succeeded
+def backup_group(config, name, buckets, threads):
+    group_config = dict(config, archive=os.path.join(config["archive"], name), group=name, include_buckets=buckets, threads=threads)
+    start = time.time()
+    status = "OK"
+
+    try:
+        # buckets created since the last run don't have an archive yet
+        create(group_config)
+
+        state = {}
+        backup(group_config, state)
+        compact(group_config, state)
+        merge(group_config, state)
+    except CommandError as e:
+        logging.error("{} failed".format(str(e)))
+        status = "CRITICAL"
+    except Exception as e:
+        logging.error("backup of {} failed: {}".format(name, str(e)))
+        status = "CRITICAL"
+
+    results.append(get_result(config, "backup {}".format(name), status, time.time() - start))
+    return status == "OK"
+
+
+# backup the bucket groups concurrently, the largest groups start first so the
+# smaller ones fill in around them. the threads are split between the groups
+# running at the same time, returns whether every group succeeded
+def backup_parallel(config):
+    groups = get_bucket_groups(config, get_buckets(config))
+    workers = max(1, min(config["parallel"], len(groups)))
+    threads = max(1, config["threads"] // workers)
+    logging.info("backing up {} bucket groups, {} at a time with {} threads each".format(len(groups), workers, threads))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(backup_group, config, name, buckets, threads) for name, buckets, size in groups]
+
+    return all(x.result() for x in futures)
+
+
+# the number of runs kept in the history file
+history_size = 100
+
+
+# return the runs recorded in the history file, oldest first
+def load_history(config):
+    try:
+        with open(config["history"], "r") as f:
+            return json.load(f)
+    except IOError:
+        return []
+    except ValueError:
+        logging.warning("ignoring invalid history file {}".format(config["history"]))
+        return []
+
+
+# write the most recent runs to the history file
+def save_history(config, history):
+    try:
+        with open(config["history"] + ".tmp", "w") as f:
+            json.dump(history[-history_size:], f)
+        os.rename(config["history"] + ".tmp", config["history"])
+    except (IOError, OSError) as e:
+        logging.error("unable to write history file: {}".format(str(e)))
+
+
+# return the thread count for this run. the thread counts of previous runs at the
+# same parallelism are ranked by their average bytes per second over their last
+# three runs, preferring runs within an hour of the time of day once there are
+# enough of them. an untried neighbour of the best count is tried next, doubling
+# and halving first and then a step either way, otherwise the best count is used
+def choose_threads(config, history):
+    low, high = config["min_threads"], config["max_threads"]
+    runs = [x for x in history if x["parallel"] == config["parallel"] and low <= x["threads"] <= high]
+
+    hour = datetime.now().hour
+    same_hour = [x for x in runs if min(abs(x["hour"] - hour), 24 - abs(x["hour"] - hour)) <= 1]
+    if len(same_hour) >= 3:
+        runs = same_hour
+
+    if not runs:
+        return min(max(config["threads"], low), high)
+
+    rates = {}
+    for run in runs:
+        rates.setdefault(run["threads"], []).append(run["bytes_per_sec"])
+    rates = dict((threads, sum(x[-3:]) / len(x[-3:])) for threads, x in rates.items())
+    logging.debug("average bytes per second by threads: {}".format(rates))
+
+    best = max(rates, key=rates.get)
+    for threads in (best * 2, best // 2, best + 1, best - 1):
+        if low <= threads <= high and threads not in rates:
+            return threads
+
+    return best
+
+
+# record the throughput of this run's backups in the history and report it, the
+# backups of parallel mode run concurrently so their rates add up
+def record_history(config, history, threads):
+    backups = [x for x in results if x["action"].startswith("cbbackupmgr backup") and x["status"] == "OK"]
+    if not backups:
+        return
+
+    size = sum(x["size"] or 0 for x in backups)
+    items = sum(x["items"] or 0 for x in backups)
+    bytes_per_sec = sum((x["size"] or 0) / max(x["duration"], 0.1) for x in backups)
+    items_per_sec = sum((x["items"] or 0) / max(x["duration"], 0.1) for x in backups)
+    duration = max(x["duration"] for x in backups)
+
+    history.append({
+        "time": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "hour": datetime.now().hour,
+        "threads": threads,
+        "parallel": config["parallel"],
+        "size": size,
+        "items": items,
+        "bytes_per_sec": round(bytes_per_sec, 1),
+        "items_per_sec": round(items_per_sec, 1)
+    })
+    save_history(config, history)
+
+    logging.info("backup with {} threads wrote {} bytes and {} items, {:.1f} bytes/s and {:.1f} items/s".format(threads, size, items, bytes_per_sec, items_per_sec))
+    results.append(get_result(config, "tune threads", "OK", duration, rate=round(bytes_per_sec / 1024 ** 2, 2), items=items, size=size, threads=threads))
+
+
 # log unsucessful and exit
 def send_exit(config, action="backup_couchbase.py", error=False):
-    if error is True:
-        results = [{"host": config["cluster"], "action": action, "status": "CRITICAL"}]
-    else:
-        results = [{"host": config["cluster"], "action": action, "status": "OK"}]
-    
+    status = "CRITICAL" if error is True else "OK"
+    results.append(get_result(config, action, status, time.time() - start_time))
+
     if config["file"]:
         send_file(results, config)
     else:
@@ -273,15 +773,42 @@ def main():
         print(yaml.dump(config, default_flow_style = False))
         sys.exit(0)
 
-    if config["create"] is True:
-        create(config)
+    if config["dry_run"]:
+        if config["parallel"] > 0:
+            for name, buckets, size in get_bucket_groups(config, get_buckets(config)):
+                print_plan(dict(config, archive=os.path.join(config["archive"], name), group=name))
+        else:
+            print_plan(config)
+        sys.exit(0)
 
     try:
-        backup(config, get_backup_list(config))
-        compact(config, get_backup_list(config))
-        merge(config, get_backup_list(config))
+        if config["history"]:
+            history = load_history(config)
+            config["threads"] = choose_threads(config, history)
+            logging.info("tuned backup threads: {}".format(config["threads"]))
+
+        if config["parallel"] > 0:
+            error = not backup_parallel(config)
+        else:
+            if config["create"] is True:
+                create(config)
+
+            # the backups are listed once and the state is updated by each action
+            state = {}
+            backup(config, state)
+            compact(config, state)
+            merge(config, state)
+            error = False
+
+        if config["history"] and not error:
+            record_history(config, history, config["threads"])
+
+        send_exit(config, error=error)
+    except CommandError as e:
+        logging.error("{} failed".format(str(e)))
+        send_exit(config, error=True)
     except Exception as e:
-        logging.error("executing cbbackupmgr command")
+        logging.exception("backup failed: {}".format(str(e)))
         send_exit(config, error=True)
 
     send_exit(config, error=False)
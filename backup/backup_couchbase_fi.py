@@ -1,25 +1,34 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
+import json
 import os
 import logging
 import logging.config
 import re
+import shutil
 import sys
 import subprocess
+import threading
+import time
 import yaml
 from datetime import datetime, timedelta
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("--archive",  dest="archive", action="store", default="/opt/couchbase/var/lib/couchbase/backups", help="The archive directory used to store backup data")
 parser.add_argument("--cbbackupmgr",  dest="cbbackupmgr", action="store", default="/opt/couchbase/bin/cbbackupmgr", help="The backup manager executable")
+parser.add_argument("--compact-budget",  dest="compact_budget", action="store", type=float, default=3600, help="The seconds compaction may take per run, backups expected to take longer to compact wait for the next run")
 parser.add_argument("--config",  dest="config", action="store", help="The path to YAML config file, reading config file overrides args default values")
 parser.add_argument("--cluster",  dest="cluster", action="store", default="localhost", help="The hostname of the Couchbase cluster")
+parser.add_argument("--delete-workers",  dest="delete_workers", action="store", type=int, default=2, help="The number of expired repos to delete at the same time")
 parser.add_argument("--dump",  dest="dump", action="store_true", default=False, help="Dump the configuration values")
 parser.add_argument("--file",  dest="file", action="store", help="The file to write results to")
 parser.add_argument("--format",  dest="format", action="store", default="{host}:{action}:{status}", help="The format in which to print results. The str of str.format()")
 parser.add_argument("--keep",  dest="keep", action="store", type=int, default=3, help="The number of repos to keep")
 parser.add_argument("--purge",  dest="purge", action="store_true", default=False, help="If the last backup failed before it finished then delete the last backup and backup from the last successful backup")
+parser.add_argument("--ledger",  dest="ledger", action="store", default="{archive}/{repo}.compaction.json", help="The file to record the compacted backups of a repo to, {archive} and {repo} are replaced")
+parser.add_argument("--min-free",  dest="min_free", action="store", type=float, default=0, help="The GiB of free space the archive needs before a backup starts, besides the estimated size of the backup")
 parser.add_argument("--password",  dest="password", action="store", default="secret", help="The password of the Couchbase cluster")
 parser.add_argument("--schedule",  dest="schedule", action="store", default="Saturday", choices=["Sunday", "Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday"], help="The day of the week to create a new repo")
 parser.add_argument("--threads",  dest="threads", action="store", type=int, default=1, help="The amount of parallelism to use")
@@ -30,6 +39,7 @@ args = parser.parse_args()
 # return results of args and config file, if passed
 def get_config():
     config = vars(args)
+    config.update(get_timeouts())
     config.update(get_logging_config())
 
     if config["config"]:
@@ -73,6 +83,120 @@ def get_logging_config():
     return {"logging": config}
 
 
+# return the seconds each cbbackupmgr action may run before it is terminated, null doesn't limit the action
+def get_timeouts():
+    timeouts = {
+        "backup": None,
+        "compact": None,
+        "config": None
+    }
+
+    return {"timeouts": timeouts}
+
+
+# the results of each cbbackupmgr command, reported along with the final status
+results = []
+start_time = time.time()
+
+# the seconds a terminated command is given to exit before it is killed
+terminate_wait = 30
+
+# the backups compacted per run while there is no compaction rate to estimate the
+# time of a compaction from, the first compaction of a repo gives the rate
+unrated_compactions = 1
+
+# cbbackupmgr reports transfers like: Copied all data in 1m2s (Avg. 21.31MiB/Sec) 31591 items / 1.15GiB
+rate_regex = re.compile("Avg\. ([\d.]+)([KMG]?i?B)/Sec")
+items_regex = re.compile("(\d+) items")
+rate_units = {"B": 1.0 / 1024 ** 2, "KB": 1.0 / 1024, "KiB": 1.0 / 1024, "MB": 1, "MiB": 1, "GB": 1024, "GiB": 1024}
+
+
+# raised when a cbbackupmgr command fails or times out
+class CommandError(Exception):
+    pass
+
+
+# log the lines of a command's output as they are written, collecting the
+# transfer rate in MiB/s and the number of items copied
+def read_stream(stream, level, metrics):
+    for line in iter(stream.readline, ""):
+        line = line.rstrip()
+        if not line:
+            continue
+
+        logging.log(level, line)
+
+        match = rate_regex.search(line)
+        if match:
+            metrics["rate"] = round(float(match.group(1)) * rate_units.get(match.group(2), 1), 2)
+
+        match = items_regex.search(line)
+        if match:
+            metrics["items"] = metrics.get("items", 0) + int(match.group(1))
+
+    stream.close()
+
+
+# run a cbbackupmgr command, streaming stdout and stderr to the log. the command
+# is terminated when it runs longer than the timeout of its action, the duration
+# and metrics of the command are added to the results and failure raises CommandError.
+# returns the result of the command
+def run_command(config, action, cmd):
+    name = "cbbackupmgr {}".format(action)
+    timeout = (config["timeouts"] or {}).get(action)
+    metrics = {}
+    timed_out = False
+
+    logging.debug("executing command: {}".format(str(cmd)))
+    start = time.time()
+    sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, bufsize=1)
+
+    readers = [
+        threading.Thread(target=read_stream, args=(sp.stdout, logging.INFO, metrics)),
+        threading.Thread(target=read_stream, args=(sp.stderr, logging.WARNING, metrics))
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    try:
+        sp.wait(timeout)
+    except subprocess.TimeoutExpired:
+        logging.error("{} exceeded timeout of {} seconds, terminating".format(name, timeout))
+        timed_out = True
+        sp.terminate()
+        try:
+            sp.wait(terminate_wait)
+        except subprocess.TimeoutExpired:
+            logging.error("{} did not exit after {} seconds, killing".format(name, terminate_wait))
+            sp.kill()
+            sp.wait()
+
+    for reader in readers:
+        reader.join(terminate_wait)
+
+    duration = time.time() - start
+    status = "CRITICAL" if timed_out or sp.returncode != 0 else "OK"
+    logging.info("{} finished with return code {} in {:.1f} seconds: {}".format(name, sp.returncode, duration, metrics))
+    result = get_result(config, name, status, duration, **metrics)
+    results.append(result)
+
+    if status == "CRITICAL":
+        raise CommandError(name)
+
+    return result
+
+
+# return a result row, every format variable has a value
+def get_result(config, action, status, duration, rate="", items="", size=""):
+    return {"host": config["cluster"], "action": action, "status": status, "duration": round(duration, 1), "rate": rate, "items": items, "size": size}
+
+
+# repo names look like 2018-01-01, backup names like 2018-01-01T00_00_00.000000000-06_00
+repo_regex = "(\d{4})-(\d{2})-(\d{2})$"
+backup_regex = "(\d{4})-(\d{2})-(\d{2})T(\d{2})_(\d{2})_(\d{2})(\S+)$"
+
+
 # return the name of the weekday
 def weekday(number):
     wd = {
@@ -114,50 +238,89 @@ def get_backup_repo(config):
     config["repo"] = repo
 
 
-# retrive the list of backups
+# retrive the list of repos, oldest first
 def get_backup_repo_list(config):
-    regex = "(\d{4})-(\d{2})-(\d{2})"
-
-    cmd =  [
-        "ls", config["archive"]
-    ]
-
     logging.info("retrieving list of repos from {}".format(config["archive"]))
-    logging.debug("executing command: {}".format(str(cmd)))
-    sp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    stdout, stderr = sp.communicate()
-    
-    if sp.returncode > 0:
-        logging.error(stdout)
-        send_exit(config, action="ls archive", error=True)
 
-    # generate backup list
-    repos = [x.group(0) for x in re.finditer(regex, stdout)]
+    try:
+        repos = [x.name for x in os.scandir(config["archive"]) if re.match(repo_regex, x.name) and x.is_dir()]
+    except OSError as e:
+        logging.error("unable to read archive: {}".format(str(e)))
+        send_exit(config, action="inspect archive", error=True)
+
     repos.sort(key=lambda x: datetime.strptime(x, "%Y-%m-%d"))
     return repos
 
 
-# retrive the list of backups
-def get_backup_list(config):
-    regex = "(\d{4})-(\d{2})-(\d{2})T(\d{2})_(\d{2})_(\d{2})(\S+)"
+# return the size in bytes of the files under path
+def get_dir_size(path):
+    size = 0
+
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            size += get_dir_size(entry.path)
+        else:
+            size += entry.stat(follow_symlinks=False).st_size
+
+    return size
+
+
+# return the name of the bucket a backup bucket directory holds, the directory
+# is named {bucket}-{uuid} and bucket-config.json has the name as well
+def get_bucket_name(path):
+    try:
+        with open(os.path.join(path, "bucket-config.json"), "r") as f:
+            return json.load(f)["name"]
+    except (IOError, ValueError, KeyError):
+        return re.sub("-[0-9a-f]{32}$", "", os.path.basename(path))
+
+
+# return the timestamp of a backup name, 2018-01-01T00_00_00.000000000-06_00
+def get_backup_time(name):
+    match = re.match(backup_regex, name)
+    timestamp = datetime(*[int(x) for x in match.groups()[:6]])
+
+    # the utc offset follows the fractional seconds
+    offset = re.search("([+-])(\d{2})_(\d{2})$", name)
+    if offset:
+        sign = -1 if offset.group(1) == "-" else 1
+        timestamp -= sign * timedelta(hours=int(offset.group(2)), minutes=int(offset.group(3)))
+
+    return timestamp
+
+
+# scan the repo directory and return its backups oldest first, without spawning
+# cbbackupmgr. each backup has a name and utc timestamp, with sizes the size in
+# bytes and the size of each bucket are added by walking the backup's files.
+def inspect_repo(config, sizes=False):
+    backups = []
+
+    for entry in os.scandir(os.path.join(config["archive"], config["repo"])):
+        if not re.match(backup_regex, entry.name) or not entry.is_dir():
+            continue
+
+        backup = {"name": entry.name, "timestamp": get_backup_time(entry.name)}
+
+        if sizes:
+            backup["buckets"] = dict((get_bucket_name(bucket.path), get_dir_size(bucket.path)) for bucket in os.scandir(entry.path) if bucket.is_dir())
+            backup["size"] = sum(backup["buckets"].values())
+
+        backups.append(backup)
+
+    # backups within the same second are ordered by the fractional seconds of the name
+    backups.sort(key=lambda x: (x["timestamp"], x["name"]))
+    return backups
 
-    cmd =  [
-        config["cbbackupmgr"], "list", 
-        "-a", config["archive"], 
-        "-r", config["repo"]
-    ]
 
+# retrive the list of backups
+def get_backup_list(config):
     logging.info("retrieving list of backups from {}/{}".format(config["archive"], config["repo"]))
-    logging.debug("executing command: {}".format(str(cmd)))
-    sp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    stdout, stderr = sp.communicate()
-    
-    if sp.returncode > 0:
-        logging.error(stdout)
-        send_exit(config, action="cbbackupmgr list", error=True)
 
-    # generate backup list
-    return [x.group(0) for x in re.finditer(regex, stdout)]
+    try:
+        return [x["name"] for x in inspect_repo(config)]
+    except OSError as e:
+        logging.error("unable to read repo: {}".format(str(e)))
+        send_exit(config, action="inspect repo", error=True)
 
 
 # initiate the backup of cluster
@@ -179,15 +342,7 @@ def backup(config):
     if config["purge"] is True:
         cmd.extend(["--purge"])
 
-    logging.debug("executing command: {}".format(str(cmd)))
-    sp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-    stdout, stderr = sp.communicate()
-    
-    if sp.returncode > 0:
-        logging.error(stdout)
-        send_exit(config, action="cbbackupmgr backup", error=True)
-    else:
-        logging.info(stdout)
+    run_command(config, "backup", cmd)
 
 
 # create the archive and repo
@@ -201,84 +356,189 @@ def create(config):
             "-r", config["repo"]
         ]
 
-        logging.debug("executing command: {}".format(str(cmd)))
-        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        stdout, stderr = sp.communicate()
-        
-        if sp.returncode > 0:
-            logging.error(stdout)
-            send_exit(config, action="cbbackupmgr config", error=True)
-        else:
-            logging.info(stdout)
+        run_command(config, "config", cmd)
+
+
+# return the path of the compaction ledger of the repo
+def get_ledger_path(config):
+    return config["ledger"].format(archive=config["archive"], repo=config["repo"])
+
+
+# return the compaction ledger of the repo, the backups compacted so far by name
+# with their size before and after compaction
+def load_ledger(config):
+    try:
+        with open(get_ledger_path(config), "r") as f:
+            return json.load(f)
+    except IOError:
+        return {}
+    except ValueError:
+        logging.warning("ignoring invalid compaction ledger {}".format(get_ledger_path(config)))
+        return {}
+
 
+# write the compaction ledger of the repo
+def save_ledger(config, ledger):
+    path = get_ledger_path(config)
 
-# compact the backups
+    try:
+        with open(path + ".tmp", "w") as f:
+            json.dump(ledger, f, indent=2, sort_keys=True)
+        os.rename(path + ".tmp", path)
+    except (IOError, OSError) as e:
+        logging.error("unable to write compaction ledger: {}".format(str(e)))
+
+
+# return the bytes per second previous compactions of the repo ran at
+def get_compaction_rate(ledger):
+    size = sum(x["before"] for x in ledger.values() if x.get("duration"))
+    duration = sum(x["duration"] for x in ledger.values() if x.get("duration"))
+
+    return size / duration if duration else None
+
+
+# compact the backups that aren't in the compaction ledger yet, newest first. with
+# a compact_budget a compaction is only started when it's expected to finish within
+# the budget at the rate of previous compactions, the rest wait for the next run.
+# without a rate only unrated_compactions backups are compacted
 def compact(config):
     backups = get_backup_list(config)
-    if len(backups) > 0:
-        logging.info("current backup list: {}".format(backups))
-        
-        # retrieve the last backup from list
-        end = backups[-1]
+    ledger = load_ledger(config)
+
+    # backups merged or removed since don't need their entries
+    pruned = dict((name, x) for name, x in ledger.items() if name in backups)
+    pending = [x for x in reversed(backups) if x not in ledger]
+    logging.info("current backup list: {}".format(backups))
+    logging.info("backups to compact: {}".format(pending))
+
+    start = time.time()
+    reclaimed = 0
+    unrated = 0
+
+    for name in pending:
+        path = os.path.join(config["archive"], config["repo"], name)
+        before = get_dir_size(path)
+
+        if config["compact_budget"]:
+            remaining = config["compact_budget"] - (time.time() - start)
+            rate = get_compaction_rate(pruned)
+            expected = before / rate if rate else 0
+
+            if remaining <= 0 or expected > remaining:
+                logging.info("not compacting {}, expected to take {:.0f} of the {:.0f} seconds left".format(name, expected, max(remaining, 0)))
+                continue
+
+            if rate is None:
+                if unrated >= unrated_compactions:
+                    logging.info("not compacting {}, no compaction rate yet".format(name))
+                    continue
+                unrated += 1
+
+        logging.info("initiating backup compaction of {}".format(name))
 
-        logging.info("initiating backup compaction of {}".format(end))
-        
         cmd =  [
             config["cbbackupmgr"], "compact", 
             "-a", config["archive"], 
             "-r", config["repo"],
-            "--backup", end
+            "--backup", name
         ]
 
-        logging.debug("executing command: {}".format(str(cmd)))
-        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        stdout, stderr = sp.communicate()
-        
-        if sp.returncode > 0:
-            logging.error(stdout)
-            send_exit(config, action="cbbackupmgr compact", error=True)
-        else:
-            logging.info(stdout)
+        result = run_command(config, "compact", cmd)
+
+        after = get_dir_size(path)
+        reclaimed += before - after
+        pruned[name] = {"compacted": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"), "before": before, "after": after, "duration": result["duration"]}
+        save_ledger(config, pruned)
+
+    if pending or len(pruned) != len(ledger):
+        save_ledger(config, pruned)
 
+    if pending:
+        logging.info("compaction reclaimed {} bytes".format(reclaimed))
+        results.append(get_result(config, "compaction", "OK", time.time() - start, size=reclaimed))
 
-# delete older repositories
-def delete(config):
+
+# return the repos past the number to keep, oldest first
+def get_expired_repos(config):
     backup_repo_list = get_backup_repo_list(config)
+    logging.info("current repo list: {}".format(backup_repo_list))
+
     if len(backup_repo_list) > config["keep"]:
-        logging.info("current repo list: {}".format(backup_repo_list))
-        logging.info("initiating repo deletion per keep: {}".format(config["keep"]))
-
-        for i in range(len(backup_repo_list) - config["keep"]):
-            delete_repo = backup_repo_list[i]
-            logging.info("removing repo: {}/{}".format(config["archive"], delete_repo))
-
-            cmd =  [
-                config["cbbackupmgr"], "remove", 
-                "-a", config["archive"], 
-                "-r", delete_repo
-            ]
-
-            logging.debug("executing command: {}".format(str(cmd)))
-            sp = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-            stdout, stderr = sp.communicate()
-            
-            if sp.returncode > 0:
-                logging.error(stdout)
-                send_exit(config, action="cbbackupmgr remove", error=True)
-            else:
-                logging.info(stdout)
-    else:
-        logging.info("current repo list: {}".format(backup_repo_list))
-        logging.info("no repo delete per keep: {}".format(config["keep"]))
+        logging.info("repos to delete per keep: {}".format(config["keep"]))
+        return [x for x in backup_repo_list[:len(backup_repo_list) - config["keep"]] if x != config["repo"]]
+
+    logging.info("no repo delete per keep: {}".format(config["keep"]))
+    return []
+
+
+# delete a repo, removing its directory from the archive. the archive lock of
+# cbbackupmgr isn't taken, deletions are only started while no cbbackupmgr
+# command runs on the archive. returns whether it succeeded
+def delete_repo(config, repo):
+    logging.info("removing repo: {}/{}".format(config["archive"], repo))
+    start = time.time()
+    status = "OK"
+
+    try:
+        shutil.rmtree(os.path.join(config["archive"], repo))
+
+        # the compaction ledger goes with the repo
+        if os.path.exists(get_ledger_path(dict(config, repo=repo))):
+            os.remove(get_ledger_path(dict(config, repo=repo)))
+    except OSError as e:
+        logging.error("unable to remove repo {}: {}".format(repo, str(e)))
+        status = "CRITICAL"
+
+    results.append(get_result(config, "remove {}".format(repo), status, time.time() - start))
+    return status == "OK"
+
+
+# start deleting repos in a pool of delete_workers threads, returns the futures
+# of the deletions, each resolving to whether it succeeded
+def delete(config, executor, repos):
+    if repos:
+        logging.info("deleting repos: {}".format(repos))
+
+    return [executor.submit(delete_repo, config, repo) for repo in repos]
+
+
+# return the free bytes of the archive's file system
+def get_free_space(config):
+    stat = os.statvfs(config["archive"])
+    return stat.f_bavail * stat.f_frsize
+
+
+# return the bytes the backup is expected to need: the size of the last backup
+# of the repo, or of the first, full, backup of the previous repo for a new repo,
+# plus min_free. only the files of that one backup are sized
+def get_required_space(config):
+    size = 0
+
+    try:
+        repo = config["repo"]
+        backups = inspect_repo(config)
+        if backups:
+            name = backups[-1]["name"]
+        else:
+            previous = [x for x in get_backup_repo_list(config) if x < config["repo"]]
+            if previous:
+                repo = previous[-1]
+                backups = inspect_repo(dict(config, repo=repo))
+            name = backups[0]["name"] if backups else None
+
+        if name:
+            size = get_dir_size(os.path.join(config["archive"], repo, name))
+    except OSError as e:
+        logging.warning("unable to estimate backup size: {}".format(str(e)))
+
+    return size + int(config["min_free"] * 1024 ** 3)
 
 
 # log unsucessful and exit
 def send_exit(config, action="backup_couchbase.py", error=False):
-    if error is True:
-        results = [{"host": config["cluster"], "action": action, "status": "CRITICAL"}]
-    else:
-        results = [{"host": config["cluster"], "action": action, "status": "OK"}]
-    
+    status = "CRITICAL" if error is True else "OK"
+    results.append(get_result(config, action, status, time.time() - start_time))
+
     if config["file"]:
         send_file(results, config)
     else:
@@ -323,11 +583,37 @@ def main():
     try:
         get_backup_repo(config)
         create(config)
-        backup(config)
-        compact(config)
-        delete(config)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, config["delete_workers"])) as executor:
+            expired = get_expired_repos(config)
+            deletions = []
+
+            # free up the disk for the backup first when it doesn't have room
+            required = get_required_space(config)
+            if get_free_space(config) < required and expired:
+                logging.info("archive has {} bytes free, backup needs {}, deleting repos first".format(get_free_space(config), required))
+                deletions = delete(config, executor, expired)
+                concurrent.futures.wait(deletions)
+                expired = []
+
+            free = get_free_space(config)
+            if free < required:
+                logging.error("archive has {} bytes free, backup needs {}".format(free, required))
+                send_exit(config, action="free space", error=True)
+
+            backup(config)
+            compact(config)
+
+            # cbbackupmgr is done with the archive
+            deletions += delete(config, executor, expired)
+            error = not all(x.result() for x in deletions)
+
+        send_exit(config, error=error)
+    except CommandError as e:
+        logging.error("{} failed".format(str(e)))
+        send_exit(config, error=True)
     except Exception as e:
-        logging.error("something went wrong executing backup script")
+        logging.exception("backup failed: {}".format(str(e)))
         send_exit(config, error=True)
 
     send_exit(config, error=False)
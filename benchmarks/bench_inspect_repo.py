@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+# Times listing a repo of thousands of backups with inspect_repo() of
+# backup_couchbase.py against cbbackupmgr list. The synthetic archive is built in a
+# temporary directory, cbbackupmgr list is only timed when --cbbackupmgr is given
+# as it needs a real cbbackupmgr and its repo metadata.
+#
+#   python3 benchmarks/bench_inspect_repo.py --backups 5000
+#   python3 benchmarks/bench_inspect_repo.py --archive /backups --repo local --cbbackupmgr /opt/couchbase/bin/cbbackupmgr
+
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backup", "backup_couchbase.py")
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--archive",  dest="archive", action="store", help="An existing archive to inspect instead of a synthetic one")
+parser.add_argument("--backups",  dest="backups", action="store", type=int, default=5000, help="The number of backups in the synthetic repo")
+parser.add_argument("--buckets",  dest="buckets", action="store", type=int, default=3, help="The number of buckets in each synthetic backup")
+parser.add_argument("--cbbackupmgr",  dest="cbbackupmgr", action="store", help="The backup manager executable to time cbbackupmgr list with")
+parser.add_argument("--repeat",  dest="repeat", action="store", type=int, default=3, help="The number of times each listing is timed, the fastest is reported")
+parser.add_argument("--repo",  dest="repo", action="store", default="local", help="The name of the repo to inspect")
+args = parser.parse_args()
+
+
+# load backup_couchbase.py as a module without its command line
+def load_backup():
+    sys.argv = [script]
+    spec = importlib.util.spec_from_file_location("backup_couchbase", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# build a repo of backups laid out like cbbackupmgr's, a backup directory per
+# backup with a directory per bucket holding its config and data shards
+def build_archive(archive, repo, backups, buckets):
+    start = datetime(2018, 1, 1)
+
+    for i in range(backups):
+        name = (start + timedelta(hours=i)).strftime("%Y-%m-%dT%H_%M_%S.000000000-06_00")
+
+        for bucket in range(buckets):
+            path = os.path.join(archive, repo, name, "bucket{0}-{1:032x}".format(bucket, bucket))
+            os.makedirs(os.path.join(path, "data"))
+
+            with open(os.path.join(path, "bucket-config.json"), "w") as f:
+                json.dump({"name": "bucket{0}".format(bucket)}, f)
+
+            with open(os.path.join(path, "data", "shard_0.sqlite.0"), "wb") as f:
+                f.write(b"x" * 1024)
+
+
+# return the fastest of repeated runs of function in seconds, and its result
+def best_time(function):
+    times = []
+    result = None
+
+    for i in range(args.repeat):
+        start = time.time()
+        result = function()
+        times.append(time.time() - start)
+
+    return min(times), result
+
+
+def main():
+    backup = load_backup()
+    archive = args.archive
+    temporary = None
+
+    if archive is None:
+        archive = temporary = tempfile.mkdtemp(prefix="bench_inspect_repo")
+        start = time.time()
+        build_archive(archive, args.repo, args.backups, args.buckets)
+        print("built {0} backups of {1} buckets in {2:.1f} seconds".format(args.backups, args.buckets, time.time() - start))
+
+    config = {"archive": archive, "repo": args.repo}
+
+    try:
+        seconds, backups = best_time(lambda: backup.inspect_repo(config))
+        print("inspect_repo: {0} backups in {1:.3f} seconds".format(len(backups), seconds))
+
+        seconds, backups = best_time(lambda: backup.inspect_repo(config, sizes=True))
+        print("inspect_repo with sizes: {0} backups, {1} bytes in {2:.3f} seconds".format(len(backups), sum(x["size"] for x in backups), seconds))
+
+        if args.cbbackupmgr:
+            cmd = [args.cbbackupmgr, "list", "-a", archive, "-r", args.repo]
+            seconds, output = best_time(lambda: subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True).stdout)
+            print("cbbackupmgr list: {0} lines in {1:.3f} seconds".format(len(output.splitlines()), seconds))
+    finally:
+        if temporary:
+            shutil.rmtree(temporary)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# Measures the peak RSS of holding and rendering check_couchbase.py results, the
+# list of dicts the results used to be kept in against the ResultStore. Each mode
+# runs in a process of its own so the peaks don't mix.
+#
+#   python3 benchmarks/bench_result_store.py --results 100000
+
+import argparse
+import importlib.util
+import os
+import resource
+import subprocess
+import sys
+import time
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "check", "check_couchbase.py")
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument("--results",  dest="results", action="store", type=int, default=100000, help="The number of results to collect")
+parser.add_argument("--hosts",  dest="hosts", action="store", type=int, default=50, help="The number of hosts the results are spread over")
+parser.add_argument("--mode",  dest="mode", action="store", choices=["baseline", "dicts", "store"], help="Run a single mode and print its peak RSS in KiB")
+args = parser.parse_args()
+
+format = "{host}:{cluster_name}:{label}:{metric}:{value}:{status}"
+
+
+# load check_couchbase.py as a module without its command line
+def load_check():
+    sys.argv = [script]
+    spec = importlib.util.spec_from_file_location("check_couchbase", script)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# yield the (host, label, metric index, value) of each synthetic result
+def synthetic_results(count, hosts, metrics):
+    for i in range(count):
+        yield "10.0.{0}.{1}".format(i % hosts // 256, i % hosts % 256), "bucket{0}".format(i // len(metrics) % 200), i % len(metrics), float(i % 97)
+
+
+# the results as they used to be kept, a dict per result referencing its metric
+# config dict, rendered into a list of lines through an items dict per line
+def run_dicts(check, metrics):
+    results = []
+
+    for host, label, metric, value in synthetic_results(args.results, args.hosts, metrics):
+        results.append({"host": host, "metric": metrics[metric], "value": value, "label": label})
+
+    lines = []
+    for result in results:
+        metric = result["metric"]
+        items = {"host": result["host"], "cluster_name": "bench", "label": result["label"], "value": check.pretty_number(result["value"]),
+                 "metric": metric["metric"], "warn": metric["warn"], "crit": metric["crit"], "op": metric["op"],
+                 "description": metric["description"], "status": "OK"}
+        lines.append(format.format(**items))
+
+    with open(os.devnull, "w") as f:
+        f.writelines(line + "\n" for line in lines)
+
+    return len(lines)
+
+
+# the results appended to a ResultStore as the collectors do, rendered one line
+# at a time
+def run_store(check, metrics):
+    rules = check.compile_rules(metrics)
+    results = check.ResultStore({})
+
+    for host, label, metric, value in synthetic_results(args.results, args.hosts, metrics):
+        results.append(check.Result(host, label, rules[metric], value))
+
+    count = 0
+    with open(os.devnull, "w") as f:
+        for status, line in check.formatted_output_list(results, "bench", {"format": format}):
+            f.write(line + "\n")
+            count += 1
+
+    return count
+
+
+# run one mode and print its peak RSS in KiB
+def run_mode(mode):
+    check = load_check()
+    metrics = [{"metric": "metric_{0}".format(i), "description": "metric {0}".format(i), "warn": 50, "crit": 90, "op": ">="} for i in range(20)]
+
+    start = time.time()
+    count = 0
+
+    if mode == "dicts":
+        count = run_dicts(check, metrics)
+    elif mode == "store":
+        count = run_store(check, metrics)
+
+    print("{0} {1} {2:.2f}".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, count, time.time() - start))
+
+
+# run each mode in its own process and report the peak RSS above the baseline
+def main():
+    if args.mode:
+        run_mode(args.mode)
+        return
+
+    peaks = {}
+    for mode in ["baseline", "dicts", "store"]:
+        output = subprocess.check_output([sys.executable, __file__, "--results", str(args.results), "--hosts", str(args.hosts), "--mode", mode], universal_newlines=True)
+        peak, count, seconds = output.split()
+        peaks[mode] = int(peak)
+
+        if mode != "baseline":
+            print("{0:6}: {1} results, peak RSS {2} KiB, {3} KiB above baseline, {4} seconds".format(mode, count, peak, int(peak) - peaks["baseline"], seconds))
+
+    print("store uses {0:.1f}% of the memory of dicts".format(100.0 * (peaks["store"] - peaks["baseline"]) / max(1, peaks["dicts"] - peaks["baseline"])))
+
+if __name__ == "__main__":
+    main()
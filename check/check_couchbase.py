@@ -10,40 +10,116 @@ Dependencies
 """
 
 import argparse
+import array
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import http.server
 import json
 import logging
 import logging.config
+import mmap
 import numbers
 import operator
 import os
+import re
 import requests
+import signal
+import struct
 import sys
+import threading
+import time
 import yaml
-import re
 
 
 # Basic setup
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("--all",  dest="all", action="store_true", default=False, help="Return results for all nodes in the cluster")
+parser.add_argument("--analytics-port",  dest="analytics_port", action="store", type=int, choices=[8095, 18095], default=8095, help="The port of the Couchbase cluster Analytics service")
+parser.add_argument("--backoff",  dest="backoff", action="store", type=float, default=0.5, help="The backoff factor in seconds between request retries")
 parser.add_argument("--bucket",  dest="bucket", action="store", default="all", help="The bucket to return statistics on")
+parser.add_argument("--cache-size",  dest="cache_size", action="store", type=int, default=256, help="The maximum number of responses kept in the response cache")
+parser.add_argument("--cache-ttl",  dest="cache_ttl", action="store", type=float, default=5, help="The number of seconds responses are reused for, 0 disables the response cache")
 parser.add_argument("--cluster",  dest="cluster", action="store", default="localhost", help="The hostname of the Couchbase cluster")
+parser.add_argument("--connect-timeout",  dest="connect_timeout", action="store", type=float, default=5, help="The number of seconds to wait for a connection to the cluster")
 parser.add_argument("--config",  dest="config", action="store", help="The path to YAML config file, reading config file overrides args values")
+parser.add_argument("--daemon",  dest="daemon", action="store_true", default=False, help="Run continuously, collecting each service on its configured interval")
 parser.add_argument("--dump",  dest="dump", action="store_true", default=False, help="Dump the configuration values")
+parser.add_argument("--eventing-port",  dest="eventing_port", action="store", type=int, choices=[8096, 18096], default=8096, help="The port of the Couchbase cluster Eventing service")
+parser.add_argument("--exporter",  dest="exporter", action="store_true", default=False, help="Run continuously like --daemon, serving the latest results in OpenMetrics format over HTTP")
+parser.add_argument("--exporter-address",  dest="exporter_address", action="store", default="0.0.0.0", help="The address the exporter listens on")
+parser.add_argument("--exporter-port",  dest="exporter_port", action="store", type=int, default=9420, help="The port the exporter listens on")
 parser.add_argument("--file",  dest="file", action="store", help="The file to write results to")
 parser.add_argument("--format",  dest="format", action="store", default="{host}:{cluster_name}:{label}:{metric}:{value}", help="The format in which to print results. The str of str.format()")
+parser.add_argument("--history-dir",  dest="history_dir", action="store", default="/var/log/couchbase/check_couchbase.history", help="The directory of the history files of derived metrics")
+parser.add_argument("--history-size",  dest="history_size", action="store", type=int, default=60, help="The number of values kept per derived metric series")
+parser.add_argument("--index-port",  dest="index_port", action="store", type=int, choices=[9102, 19102], default=9102, help="The port of the Couchbase cluster Index service")
+parser.add_argument("--max-staleness",  dest="max_staleness", action="store", type=float, default=300, help="The number of seconds the exporter serves results after they were collected, older results are answered with 503")
+parser.add_argument("--max-workers",  dest="max_workers", action="store", type=int, default=8, help="The maximum number of concurrent requests to the cluster")
+parser.add_argument("--pool-hosts",  dest="pool_hosts", action="store", type=int, default=32, help="The number of hosts to keep connection pools for")
+parser.add_argument("--pool-size",  dest="pool_size", action="store", type=int, default=8, help="The number of keep-alive connections to pool per host")
 parser.add_argument("--port",  dest="port", action="store", type=int, choices=[8091, 18091], default=8091, help="The port of the Couchbase cluster")
 parser.add_argument("--password",  dest="password", action="store", default="secret", help="The password of the Couchbase cluster")
 parser.add_argument("--fts-port",  dest="fts_port", action="store", type=int, choices=[8094, 18094], default=8094, help="The port of the Couchbase cluster FTS service")
 parser.add_argument("--protocol",  dest="protocol", action="store", choices=["http", "https"], default="http", help="The protocol of the Couchbase cluster")
 parser.add_argument("--query-port",  dest="query_port", action="store", type=int, choices=[8093, 18093], default=8093, help="The port of the Couchbase cluster Query service")
+parser.add_argument("--retries",  dest="retries", action="store", type=int, default=2, help="The number of times a failed request is retried")
+parser.add_argument("--samples",  dest="samples", action="store", type=int, default=0, help="The number of latest data service samples to average, 0 averages the whole zoom window")
+parser.add_argument("--stats-mode",  dest="stats_mode", action="store", choices=["node", "cluster"], default="node", help="Report data service stats per node, or the cluster aggregate of each bucket once")
+parser.add_argument("--timeout",  dest="timeout", action="store", type=float, default=10, help="The number of seconds to wait for a response from the cluster")
 parser.add_argument("--username",  dest="username", action="store", default="readonly", help="The username of the Couchbase cluster")
 parser.add_argument("--verbose",  dest="verbose", action="store_true", default=False, help="Enable debugging logging")
+parser.add_argument("--zoom",  dest="zoom", action="store", choices=["minute", "hour", "day", "week", "month", "year"], default="minute", help="The data service stats zoom level the samples are taken from")
 args = parser.parse_args()
 
+# HTTP session shared by all requests, see get_session()
+session = None
+
+# Thread pool the requests run in, see get_executor()
+executor = None
+
+# (host, port, uri) -> (expiry, response) of recent responses, least recently
+# used first, and the requests in flight, see couchbase_request()
+response_cache = collections.OrderedDict()
+inflight_requests = {}
+response_lock = threading.Lock()
+response_counts = {"hits": 0, "misses": 0, "coalesced": 0}
+
+# Compiled metric config, see compile_rules()
+Rule = collections.namedtuple("Rule", ["metric", "description", "warn", "crit", "op", "compare", "thresholds", "aggregate", "type", "window", "name"])
+
+# A collected metric value, the status is evaluated against the rule on output
+Result = collections.namedtuple("Result", ["host", "label", "rule", "value"])
+
+# Text and log level of each result status
+status_texts = {0: "OK", 1: "WARNING", 2: "CRITICAL"}
+status_levels = {0: logging.INFO, 1: logging.WARNING, 2: logging.CRITICAL}
+
+# Milliseconds between data service samples per zoom level
+zoom_intervals = {"minute": 1000, "hour": 4000, "day": 60000, "week": 600000, "month": 1800000, "year": 21600000}
+
+# (host, bucket) -> (lastTStamp, local time) of the latest data service stats, see get_stats_uri()
+last_tstamps = {}
+
+# Metric types, the values of types other than value are derived from the
+# history of the series, see derive_value()
+metric_types = ["value", "rate", "delta", "avg", "slope"]
+
+# A history file is a ring of (timestamp, value) records after a header holding
+# the number of records ever written, see append_history()
+history_header = struct.Struct("<Q")
+history_record = struct.Struct("<dd")
+
+# path -> memory map of the history files opened so far, see get_history()
+history_maps = {}
+
+# (collection time, OpenMetrics text) of the latest results, see send_exporter()
+exporter_cache = (0, None)
+
 
 def main():
     config = get_config()
-    results = []
 
     logging.config.dictConfig(config["logging"])
 
@@ -54,8 +130,148 @@ def main():
         print(yaml.dump(config, default_flow_style = False))
         sys.exit(0)
 
-    tasks = couchbase_request(config["cluster"], config["port"], "/pools/default/tasks", config)
-    pools_default = couchbase_request(config["cluster"], config["port"], "/pools/default", config)
+    config["rules"] = get_rules(config)
+    get_session(config)
+
+    if config["daemon"] or config["exporter"]:
+        # exit the loop cleanly on SIGTERM
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    if config["exporter"]:
+        run_exporter(config)
+    elif config["daemon"]:
+        run_daemon(config)
+    else:
+        cluster_name, results = collect(config)
+        send_results(results, cluster_name, config)
+
+
+# Runs collection on the configured per service intervals until terminated,
+# the results of each collection are passed to send
+def run_daemon(config, send=None):
+    send = send or send_results
+
+    # services missing from the configured intervals keep their default
+    intervals = get_intervals()["intervals"]
+    intervals.update(config["intervals"] or {})
+    next_run = {}
+    cache = {}
+
+    logging.info("Starting daemon with intervals: {}".format(intervals))
+
+    while True:
+        now = time.time()
+        due = [service for service in intervals if next_run.get(service, 0) <= now]
+
+        for service in due:
+            next_run[service] = now + intervals[service]
+
+        logging.debug("Collecting services: {}".format(due))
+
+        try:
+            cluster_name, results = collect(config, due, cache)
+            send(results, cluster_name, config)
+        except Exception as e:
+            logging.error("Failed to complete collection: {}".format(str(e)))
+
+        time.sleep(max(0, min(next_run.values()) - time.time()))
+
+
+# Runs the daemon loop in the background and serves the results of its latest
+# collection, scrapes never make requests to the cluster
+def run_exporter(config):
+    collector = threading.Thread(target=run_daemon, args=(config, send_exporter))
+    collector.daemon = True
+    collector.start()
+
+    server = http.server.ThreadingHTTPServer((config["exporter_address"], config["exporter_port"]), ExporterHandler)
+    server.config = config
+
+    logging.info("Serving OpenMetrics on {0}:{1}/metrics".format(config["exporter_address"], config["exporter_port"]))
+    server.serve_forever()
+
+
+# Answers scrapes of /metrics from the exporter cache, with 503 until the first
+# collection completes or once the results are older than --max-staleness
+class ExporterHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        collected, text = exporter_cache
+        age = time.time() - collected
+
+        if self.path.split("?")[0] != "/metrics":
+            self.send_text(404, "Not found\n", "text/plain; charset=utf-8")
+        elif text is None:
+            self.send_text(503, "No results collected yet\n", "text/plain; charset=utf-8")
+        elif age > self.server.config["max_staleness"]:
+            self.send_text(503, "Results are stale, last collected {0:.0f} seconds ago\n".format(age), "text/plain; charset=utf-8")
+        else:
+            self.send_text(200, text, "application/openmetrics-text; version=1.0.0; charset=utf-8")
+
+    def send_text(self, code, text, content_type):
+        body = text.encode("utf-8")
+
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Exporter: {0} {1}".format(self.address_string(), format % args))
+
+
+# Collects results for the cluster, only services in due are requested and the
+# rest are taken from cache, when set. Returns the cluster name and results.
+def collect(config, due=None, cache=None):
+    loop = asyncio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(collect_services(config, due, {} if cache is None else cache))
+    finally:
+        log_response_counts()
+
+        # requests left over when collection is interrupted, such as by SIGTERM
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+
+        if pending:
+            loop.run_until_complete(asyncio.wait(pending))
+
+        loop.close()
+
+
+# State of a collection shared by the service plugins. Requests are made with
+# fetch() which runs them concurrently on the shared session, at most
+# --max-workers at a time. targets resolves to the (host, node) pairs collected.
+class Collection(object):
+    def __init__(self, config, due, cache):
+        self.config = config
+        self.due = due
+        self.cache = cache
+        self.loop = asyncio.get_event_loop()
+        self.semaphore = asyncio.Semaphore(max(1, config["max_workers"]))
+        self.targets = self.loop.create_future()
+
+    # keys are (host, service, ...), they are due when their service is due or
+    # when there is nothing cached yet
+    def is_due(self, key):
+        return self.due is None or key[1] in self.due or key not in self.cache
+
+    async def fetch(self, host, port, uri, service=None):
+        async with self.semaphore:
+            return await self.loop.run_in_executor(get_executor(self.config), couchbase_request, host, port, uri, self.config, service)
+
+
+# Collects the registered services of each node concurrently. The prepare
+# coroutines of the services start along with the /pools/default request
+async def collect_services(config, due, cache):
+    collection = Collection(config, due, cache)
+    results = ResultStore(config)
+
+    prepares = [asyncio.ensure_future(service.prepare(collection)) for service in service_registry.values() if service.prepare]
+
+    pools_default = await collection.fetch(config["cluster"], config["port"], "/pools/default")
 
     # set the cluster name
     cluster_name = pools_default.get("clusterName", "default")
@@ -64,8 +280,10 @@ def main():
     nodes = pools_default.get("nodes", [])
 
     if nodes == []:
-        results.append({"host": config["cluster"], "metric": {"crit": "unhealthy", "warn": "unhealthy", "op": "=", "metric": "connectionStatus", "description": "communication with node"}, "value": "unhealthy", "label": "node"})
+        rule = compile_rules([{"crit": "unhealthy", "warn": "unhealthy", "op": "=", "metric": "connectionStatus", "description": "communication with node"}])[0]
+        results.append(Result(config["cluster"], "node", rule, "unhealthy"))
 
+    targets = []
     for node in nodes:
         if config["all"] is False and "thisNode" not in node:
             continue
@@ -75,31 +293,31 @@ def main():
         else:
             # node is formatted a hostname:port
             host, port = node["hostname"].split(":")
-        
-        services = node["services"]
 
-        results = process_node_stats(host, node, config, results)
+        targets.append((host, node))
 
-        if "kv" in services:
-            results = process_xdcr_stats(host, tasks, config, results)
+    collection.targets.set_result(targets)
 
-            # all is a special case where we process stats for all buckets
-            if config["bucket"] == "all":
-                for bucket in couchbase_request(host, config["port"], "/pools/default/buckets?skipMap=true", config):
-                    results = process_data_stats(host, bucket["name"], config["data"], config, results)
-            else:
-                results = process_data_stats(host, config["bucket"], config["data"], config, results)
+    await asyncio.gather(*prepares)
 
-        if "n1ql" in services:
-            results = process_query_stats(host, config, results)
+    # jobs are keyed by (host, service) and joined in job order below, node
+    # stats come with /pools/default which is requested every time
+    jobs = []
+    for host, node in targets:
+        for service in service_registry.values():
+            if service.node_service is None or service.node_service in node["services"]:
+                jobs.append(((host, service.name), service, node))
 
-        if "fts" in services:
-            results = process_fts_stats(host, config, results)
+    run = [(key, service, node) for key, service, node in jobs if not service.cached or collection.is_due(key)]
 
-    if config["file"]:
-        send_file(results, cluster_name, config)
-    else:
-        send_stdout(results, cluster_name, config)
+    # each job returns its own store, kept in the cache until the service is due
+    for (key, service, node), job_results in zip(run, await asyncio.gather(*[service.collect(collection, key[0], node) for key, service, node in run])):
+        cache[key] = job_results
+
+    for key, service, node in jobs:
+        results.merge(cache[key])
+
+    return cluster_name, results
 
 
 # Attempts to load the configuration file overrides any args if set in this file
@@ -108,6 +326,8 @@ def get_config():
     config.update(get_node())
     config.update(get_data())
     config.update(get_xdcr())
+    config.update(get_intervals())
+    config.update(get_timeouts())
     config.update(get_logging())
 
     if config["config"]:
@@ -129,31 +349,29 @@ def get_config():
 
 # Validates metric config
 def validate_metric(metric, samples):
-    if "metric" not in metric or metric["metric"] is None:
+    if metric.metric is None:
         logging.warning("Skipped: metric name not set")
         return False
 
-    name = metric["metric"]
+    name = metric.metric
 
     if name not in samples:
         logging.warning("Skipped: metric does not exist: {0}".format(name))
         return False
 
-    if "description" not in metric or metric["description"] is None:
+    if metric.description is None:
         logging.warning("Skipped: service description is not set for metric: {0}".format(name))
         return False
 
 
 # Formats numbers with a max precision 2 and removes trailing zeros
 def pretty_number(f):
-    value = str(round(f, 2)).rstrip("0").rstrip(".")
+    value = round(f, 2)
 
-    if "." in value:
-        return float(value)
-    elif value == "":
-        return 0
-    else:
+    if isinstance(value, float) and value.is_integer():
         return int(value)
+    else:
+        return value
 
 
 # Averages multiple metric samples to smooth out values
@@ -163,45 +381,296 @@ def avg(samples):
 
 # For dynamic comparisons
 # Thanks to https://stackoverflow.com/a/18591880
-def compare(inp, relate, cut):
-    ops = {">": operator.gt,
-           "<": operator.lt,
-           ">=": operator.ge,
-           "<=": operator.le,
-           "=": operator.eq}
-    return ops[relate](inp, cut)
+operators = {">": operator.gt,
+             "<": operator.lt,
+             ">=": operator.ge,
+             "<=": operator.le,
+             "=": operator.eq}
+
+
+# Compiles metric configs into rules with the comparator bound and the
+# thresholds ordered by severity, metrics with an invalid operator are skipped
+def compile_rules(metrics):
+    rules = []
+
+    for m in metrics:
+        op = m.get("op", ">=")
+        metric_type = m.get("type", "value")
+        window = m.get("window", 2)
+
+        if op not in operators:
+            logging.warning("Skipped metric: \"{0}\", invalid operator: {1}".format(m.get("description"), op))
+            continue
+
+        if metric_type not in metric_types:
+            logging.warning("Skipped metric: \"{0}\", invalid type: {1}".format(m.get("description"), metric_type))
+            continue
+
+        if not isinstance(window, int) or window < 1:
+            logging.warning("Skipped metric: \"{0}\", invalid window: {1}".format(m.get("description"), window))
+            continue
+
+        # derived metrics are reported with the type appended to the metric name
+        name = m.get("metric") if metric_type == "value" else "{0}_{1}".format(m.get("metric"), metric_type)
+
+        # string thresholds compare against string values such as node status
+        thresholds = tuple((threshold, status, status_text) for threshold, status, status_text in [(m.get("crit"), 2, "CRITICAL"), (m.get("warn"), 1, "WARNING")]
+                           if isinstance(threshold, (numbers.Number, str)))
+
+        rules.append(Rule(m.get("metric"), m.get("description"), m.get("warn"), m.get("crit"), op, operators[op], thresholds, m.get("aggregate", "index"), metric_type, window, name))
+
+    return tuple(rules)
+
+
+# Compiles the metric configs of each service once the config is final
+def get_rules(config):
+    rules = {}
+
+    for service in service_registry:
+        if config.get(service) is not None:
+            rules[service] = compile_rules(config[service])
+
+    return rules
 
 
 # Determines metric status based on value and thresholds
-def eval_status(value, critical, warning, op):
-    if isinstance(critical, numbers.Number) and compare(value, op, critical):
-        return 2, "CRITICAL"
-    elif isinstance(critical, str) and compare(value, op, critical):
-        return 2, "CRITICAL"
-    elif isinstance(warning, numbers.Number) and compare(value, op, warning):
-        return 1, "WARNING"
-    elif isinstance(warning, str) and compare(value, op, warning):
-        return 1, "WARNING"
-    else:
-        return 0, "OK"
+def eval_status(value, rule):
+    for threshold, status, status_text in rule.thresholds:
+        if rule.compare(value, threshold):
+            return status, status_text
+
+    return 0, "OK"
+
+
+# Builds the bucket stats path, the stats of a node when node is its hostname
+# otherwise the stats aggregated across the cluster
+def get_stats_path(bucket, node=None):
+    if node is None:
+        return "/pools/default/buckets/{0}/stats".format(bucket)
+
+    return "/pools/default/buckets/{0}/nodes/{1}/stats".format(bucket, node)
+
+
+# Builds the bucket stats uri, haveTStamp limits the response to the samples
+# in the averaging window instead of the whole zoom level
+def get_stats_uri(host, bucket, config, node=None):
+    uri = "{0}?zoom={1}".format(get_stats_path(bucket, node), config["zoom"])
+
+    if config["samples"] > 0:
+        now = int(time.time() * 1000)
+
+        # estimate the server time from the last response to avoid clock skew
+        if (host, bucket) in last_tstamps:
+            tstamp, seen = last_tstamps[(host, bucket)]
+            now = tstamp + now - seen
+
+        uri += "&haveTStamp={0}".format(now - config["samples"] * zoom_intervals[config["zoom"]])
+
+    return uri
+
+
+# Service collector plugins in collection order, see register_service()
+Service = collections.namedtuple("Service", ["name", "node_service", "collect", "prepare", "cached", "interval"])
+service_registry = collections.OrderedDict()
+
+
+# Registers a coroutine collecting the results of a service of a node as a
+# plugin. Nodes are collected when they run node_service, None collects every
+# node. prepare is a coroutine run once per collection for requests shared by
+# the nodes. With --daemon the results of cached plugins are kept until due,
+# interval is the default seconds between collections of the service.
+def register_service(name, node_service=None, prepare=None, cached=True, interval=30):
+    def register(collect):
+        service_registry[name] = Service(name, node_service, collect, prepare, cached, interval)
+        return collect
+
+    return register
+
+
+# Evaluates node stats, node stats come with /pools/default
+@register_service("node", cached=False, interval=10)
+async def collect_node(collection, host, node):
+    return process_node_stats(host, node, collection.config, ResultStore(collection.config))
+
+
+# Requests the XDCR tasks and the stats of the running replications once for
+# all kv nodes
+async def prepare_xdcr(collection):
+    config, cache = collection.config, collection.cache
+    tasks_key = (config["cluster"], "xdcr", "tasks")
+
+    if collection.is_due(tasks_key):
+        cache[tasks_key] = await collection.fetch(config["cluster"], config["port"], "/pools/default/tasks", "xdcr")
+
+    targets = await collection.targets
+
+    # XDCR stats are requested once and shared by all kv nodes
+    kv_count = len([host for host, node in targets if "kv" in node["services"]])
+    if kv_count > 0 and collection.is_due((config["cluster"], "xdcr", "stats")):
+        xdcr_stats = await get_xdcr_stats(collection, cache[tasks_key])
+        cache[(config["cluster"], "xdcr", "stats")] = xdcr_stats
+        logging.debug("XDCR stats: {0} requests for {1} kv nodes, {2} requests saved".format(len(xdcr_stats), kv_count, len(xdcr_stats) * (kv_count - 1)))
+
+
+@register_service("xdcr", "kv", prepare=prepare_xdcr, interval=60)
+async def collect_xdcr(collection, host, node):
+    config, cache = collection.config, collection.cache
+    return process_xdcr_stats(host, cache[(config["cluster"], "xdcr", "tasks")], cache.get((config["cluster"], "xdcr", "stats"), {}), config, ResultStore(config))
+
+
+# Requests the bucket list once for all kv nodes, all is a special case where
+# we process stats for all buckets. With --stats-mode cluster the aggregate
+# stats of each bucket are requested once here, instead of once per kv node
+async def prepare_data(collection):
+    config, cache = collection.config, collection.cache
+    targets = await collection.targets
+    kv_hosts = [host for host, node in targets if "kv" in node["services"]]
+
+    if kv_hosts == [] or not collection.is_due((config["cluster"], "data", "buckets")):
+        return
+
+    buckets = [config["bucket"]]
+    if config["bucket"] == "all":
+        bucket_list = await collection.fetch(config["cluster"], config["port"], "/pools/default/buckets?skipMap=true", "data")
+        buckets = [bucket["name"] for bucket in bucket_list]
+
+    cache[(config["cluster"], "data", "buckets")] = buckets
+
+    if config["stats_mode"] == "cluster":
+        responses = await asyncio.gather(*[fetch_data_stats(collection, config["cluster"], bucket) for bucket in buckets])
+        cache[(config["cluster"], "data", "stats")] = (kv_hosts[0], list(zip(buckets, responses)))
+        logging.debug("Data stats: {0} requests for {1} kv nodes, {2} requests saved".format(len(buckets), len(kv_hosts), len(buckets) * (len(kv_hosts) - 1)))
+
+
+# Per node mode requests the node stats of each bucket, cluster mode reports the
+# aggregate requested by prepare_data() once, with the first kv node
+@register_service("data", "kv", prepare=prepare_data, interval=60)
+async def collect_data(collection, host, node):
+    config, cache = collection.config, collection.cache
+    rules = config["rules"].get("data", ())
+    results = ResultStore(config)
+
+    if config["stats_mode"] == "cluster":
+        first, responses = cache.get((config["cluster"], "data", "stats"), (None, []))
+
+        if host == first:
+            for bucket, stats in responses:
+                process_data_stats(config["cluster"], bucket, stats, rules, config, results)
+
+        return results
+
+    buckets = cache.get((config["cluster"], "data", "buckets"), [])
+    responses = await asyncio.gather(*[fetch_data_stats(collection, host, bucket, node["hostname"]) for bucket in buckets])
+
+    for bucket, stats in zip(buckets, responses):
+        process_data_stats(host, bucket, stats, rules, config, results)
+
+    return results
+
+
+@register_service("query", "n1ql")
+async def collect_query(collection, host, node):
+    config = collection.config
+
+    if "query" not in config["rules"]:
+        logging.warning("Query service is running but no metrics are configured")
+        return ResultStore(config)
+
+    stats = await collection.fetch(host, config["query_port"], "/admin/stats", "query")
+    return process_query_stats(host, stats, config, ResultStore(config))
+
+
+@register_service("fts", "fts")
+async def collect_fts(collection, host, node):
+    config = collection.config
+
+    if "fts" not in config["rules"]:
+        logging.warning("FTS service is running but no metrics are configured")
+        return ResultStore(config)
+
+    stats = await collection.fetch(host, config["fts_port"], "/api/nsstats", "fts")
+    return process_fts_stats(host, stats, config, ResultStore(config))
+
+
+@register_service("index", "index")
+async def collect_index(collection, host, node):
+    config = collection.config
+
+    if "index" not in config["rules"]:
+        logging.warning("Index service is running but no metrics are configured")
+        return ResultStore(config)
+
+    stats = await collection.fetch(host, config["index_port"], "/stats", "index")
+    return process_index_stats(host, stats, config, ResultStore(config))
+
+
+@register_service("eventing", "eventing")
+async def collect_eventing(collection, host, node):
+    config = collection.config
+
+    if "eventing" not in config["rules"]:
+        logging.warning("Eventing service is running but no metrics are configured")
+        return ResultStore(config)
+
+    stats = await collection.fetch(host, config["eventing_port"], "/api/v1/stats", "eventing")
+    return process_eventing_stats(host, stats, config, ResultStore(config))
+
+
+# The ingestion status is only requested when an ingestion metric is configured,
+# both requests run concurrently
+@register_service("analytics", "cbas")
+async def collect_analytics(collection, host, node):
+    config = collection.config
+
+    if "analytics" not in config["rules"]:
+        logging.warning("Analytics service is running but no metrics are configured")
+        return ResultStore(config)
+
+    fetches = [collection.fetch(host, config["analytics_port"], "/analytics/node/stats", "analytics")]
+
+    if any(m.metric in ingestion_metrics for m in config["rules"]["analytics"]):
+        fetches.append(collection.fetch(host, config["analytics_port"], "/analytics/status/ingestion", "analytics"))
+
+    responses = await asyncio.gather(*fetches)
+    ingestion = responses[1] if len(responses) > 1 else {}
+    return process_analytics_stats(host, responses[0], ingestion, config, ResultStore(config))
+
+
+# Requests the data service stats of a bucket, of node when it is set
+async def fetch_data_stats(collection, host, bucket, node=None):
+    config = collection.config
+    s = await collection.fetch(host, config["port"], get_stats_uri(host, bucket, config, node), "data")
+
+    # the server clock may be behind ours, fall back to the whole zoom level
+    if "op" in s and len(s["op"]["samples"].get("timestamp", [None])) == 0:
+        logging.debug("No samples in window for bucket {0}, requesting zoom level {1}".format(bucket, config["zoom"]))
+        s = await collection.fetch(host, config["port"], "{0}?zoom={1}".format(get_stats_path(bucket, node), config["zoom"]), "data")
+
+    return s
 
 
 # Evalutes data service stats and sends check results
-def process_data_stats(host, bucket, metrics, config, results):
+def process_data_stats(host, bucket, s, metrics, config, results):
     logging.debug("Processing Data Stats...{}".format(host))
-    s = couchbase_request(host, config["port"],  "/pools/default/buckets/{0}/stats".format(bucket), config)
-    
+
     if "op" in s:
         stats = s["op"]["samples"]
 
+        if "lastTStamp" in s["op"]:
+            last_tstamps[(host, bucket)] = (s["op"]["lastTStamp"], int(time.time() * 1000))
+
+        # only average the samples in the window
+        if config["samples"] > 0:
+            stats = dict((name, samples[-config["samples"]:]) for name, samples in stats.items())
+
         for m in metrics:
-            if m["metric"] == "percent_quota_utilization":
+            if m.metric == "percent_quota_utilization":
                 value = avg(stats["mem_used"]) / (avg(stats["ep_mem_high_wat"]) * 1.0) * 100
-            elif m["metric"] == "percent_metadata_utilization":
+            elif m.metric == "percent_metadata_utilization":
                 value = avg(stats["ep_meta_data_memory"]) / (avg(stats["ep_mem_high_wat"]) * 1.0) * 100
-            elif m["metric"] == "disk_write_queue":
+            elif m.metric == "disk_write_queue":
                 value = avg(stats["ep_queue_size"]) + avg(stats["ep_flusher_todo"])
-            elif m["metric"] == "total_ops":
+            elif m.metric == "total_ops":
                 value = 0
                 for op in ["cmd_get", "cmd_set", "incr_misses", "incr_hits", "decr_misses", "decr_hits", "delete_misses", "delete_hits"]:
                     value += avg(stats[op])
@@ -209,85 +678,96 @@ def process_data_stats(host, bucket, metrics, config, results):
                 if validate_metric(m, stats) is False:
                     continue
 
-                value = avg(stats[m["metric"]])
+                value = avg(stats[m.metric])
 
-            results.append({"host": host, "metric": m, "value": value, "label": bucket})
+            results.append(Result(host, bucket, m, value))
 
     return results
 
 
+# Requests the stats of each XDCR replication metric once per run, the nodeStats
+# in the response cover every node. Returns {(task id, metric): nodeStats}
+async def get_xdcr_stats(collection, tasks):
+    config = collection.config
+    keys = []
+    fetches = []
+
+    for task in tasks:
+        if task["type"] != "xdcr" or task["status"] not in ["running", "paused"]:
+            continue
+
+        for m in config["rules"].get("xdcr", ()):
+            if m.metric == "status":
+                continue
+
+            # REST API requires the destination endpoint to be URL encoded.
+            destination = requests.utils.quote("replications/{0}/{1}".format(task["id"], m.metric), safe="")
+
+            uri = "/pools/default/buckets/{0}/stats/{1}".format(task["source"], destination)
+            keys.append((task["id"], m.metric))
+            fetches.append(collection.fetch(config["cluster"], config["port"], uri, "xdcr"))
+
+    return dict((key, stats.get("nodeStats", {})) for key, stats in zip(keys, await asyncio.gather(*fetches)))
+
+
 # Evaluates XDCR stats and sends check results
-def process_xdcr_stats(host, tasks, config, results):
+def process_xdcr_stats(host, tasks, xdcr_stats, config, results):
     logging.debug("Processing XDCR Stats...{}".format(host))
     for task in tasks:
         if task["type"] == "xdcr":
-            if "xdcr" not in config or config["xdcr"] is None:
+            if "xdcr" not in config["rules"]:
                 logging.warning("XDCR is running but no metrics are configured")
                 return results
 
-            metrics = config["xdcr"]
+            metrics = config["rules"]["xdcr"]
 
             for m in metrics:
                 # task["id"] looks like this: {GUID}/{source_bucket}/{destination_bucket}
                 label = "xdcr {0}/{1}".format(task["id"].split("/")[1], task["id"].split("/")[2])
 
-                if m["metric"] == "status":
+                if m.metric == "status":
                     value = task["status"]
-                    results.append({"host": host, "metric": m, "value": value, "label": label})
+                    results.append(Result(host, label, m, value))
                 elif task["status"] in ["running", "paused"]:
-                    # REST API requires the destination endpoint to be URL encoded.
-                    destination = requests.utils.quote("replications/{0}/{1}".format(task["id"], m["metric"]), safe="")
-
-                    uri = "/pools/default/buckets/{0}/stats/{1}".format(task["source"], destination)
-                    stats = couchbase_request(host, config["port"], uri, config)
+                    node_stats = xdcr_stats.get((task["id"], m.metric), {})
 
-                    for node in stats.get("nodeStats", []):
+                    for node in node_stats:
                         # node is formatted as host:port
                         if host == node.split(":")[0]:
-                            if len(stats["nodeStats"][node]) == 0:
-                                logging.error("Invalid XDCR metric: {0}".format(m["metric"]))
+                            if len(node_stats[node]) == 0:
+                                logging.error("Invalid XDCR metric: {0}".format(m.metric))
                                 continue
 
-                            value = avg(stats["nodeStats"][node])
-                            results.append({"host": host, "metric": m, "value": value, "label": label})
+                            value = avg(node_stats[node])
+                            results.append(Result(host, label, m, value))
 
     return results
 
 
 # Evaluates query service stats and sends check results
-def process_query_stats(host, config, results):
+def process_query_stats(host, stats, config, results):
     logging.debug("Processing Query Stats...{}".format(host))
-    if "query" not in config:
-        logging.warning("Query service is running but no metrics are configured")
-        return results
-
-    metrics = config["query"]
-    stats = couchbase_request(host, config["query_port"],  "/admin/stats", config, "query")
+    metrics = config["rules"]["query"]
 
     for m in metrics:
         if validate_metric(m, stats) is False:
             continue
 
-        value = stats[m["metric"]]
+        value = stats[m.metric]
 
         # Convert nanoseconds to milliseconds
-        if m["metric"] in ["request_timer.75%", "request_timer.95%", "request_timer.99%"]:
+        if m.metric in ["request_timer.75%", "request_timer.95%", "request_timer.99%"]:
             value = value / 1000 / 1000
 
-        results.append({"host": host, "metric": m, "value": value, "label": "query"})
+        results.append(Result(host, "query", m, value))
 
     return results
 
 
 # Evaluates FTS service stats and sends check results
-def process_fts_stats(host, config, results):
+def process_fts_stats(host, stats, config, results):
     logging.debug("Processing FTS Stats...{}".format(host))
-    if "fts" not in config or config["fts"] is None:
-        logging.warning("FTS service is running but no metrics are configured")
-        return results
-
-    metrics = config["fts"]
-    stats = couchbase_request(host, config["fts_port"],  "/api/nsstats", config, "fts")
+    metrics = config["rules"]["fts"]
 
     for m in metrics:
         value = 0
@@ -297,41 +777,358 @@ def process_fts_stats(host, config, results):
         for stat in stats:
             metric = stat.split(":")
 
-            if len(metric) != 3 or m["metric"] != metric[2]:
+            if len(metric) != 3 or m.metric != metric[2]:
                 continue
 
             label = "fts {0}:{1}".format(metric[0], metric[1])
             value = stats[stat]
 
-            results.append({"host": host, "metric": m, "value": value, "label": label})
+            results.append(Result(host, label, m, value))
+
+    return results
+
+
+# Evaluates eventing service stats and sends check results. Stats are reported
+# per function, a metric is the dotted path of a stat in the function stats
+# such as events_remaining.dcp_backlog or failure_stats.timeout_count
+def process_eventing_stats(host, stats, config, results):
+    logging.debug("Processing Eventing Stats...{}".format(host))
+    metrics = config["rules"]["eventing"]
+
+    if not isinstance(stats, list):
+        return results
+
+    for function in stats:
+        label = "eventing {0}".format(function.get("function_name"))
+
+        for m in metrics:
+            value = get_stat(function, m.metric)
+
+            if not isinstance(value, numbers.Number):
+                logging.debug("Eventing stat does not exist: {0}".format(m.metric))
+                continue
+
+            results.append(Result(host, label, m, value))
+
+    return results
+
+
+# Metrics derived from the analytics ingestion status of each link
+ingestion_metrics = ["ingestion_time_lag", "ingestion_progress"]
+
+
+# Evaluates analytics service stats and sends check results. percent_heap_used
+# is derived from the node heap stats, ingestion_time_lag is the highest
+# timeLag in milliseconds and ingestion_progress the lowest progress in percent
+# across the ingestion state of every link, other metrics are node stats
+def process_analytics_stats(host, stats, ingestion, config, results):
+    logging.debug("Processing Analytics Stats...{}".format(host))
+    metrics = config["rules"]["analytics"]
+    states = [state for link in ingestion.get("links", []) for state in link.get("state", [])]
+
+    for m in metrics:
+        if m.metric == "percent_heap_used":
+            heap = stats.get("heap_memory_max") or stats.get("heap_memory_committed")
+
+            if heap:
+                value = stats.get("heap_memory_used", 0) / (heap * 1.0) * 100
+                results.append(Result(host, "analytics", m, value))
+        elif m.metric == "ingestion_time_lag":
+            lags = [state["timeLag"] for state in states if "timeLag" in state]
+
+            if lags:
+                results.append(Result(host, "analytics", m, max(lags)))
+        elif m.metric == "ingestion_progress":
+            progress = [state["progress"] for state in states if "progress" in state]
+
+            if progress:
+                results.append(Result(host, "analytics", m, min(progress) * 100))
+        elif validate_metric(m, stats) is not False:
+            results.append(Result(host, "analytics", m, stats[m.metric]))
 
     return results
 
 
-# Evaluates node stats and sends check results
+# Evaluates index service stats and sends check results. Index stats are named
+# "bucket:index:stat", or "bucket:scope:collection:index:stat" for indexes on
+# named collections, and there are thousands of them. They are split once and
+# grouped by the configured stat in a single pass, then each metric is reported
+# per index or summed per bucket with aggregate: bucket. Stats without a bucket,
+# such as memory_used, are reported for the node.
+def process_index_stats(host, stats, config, results):
+    logging.debug("Processing Index Stats...{}".format(host))
+    metrics = config["rules"]["index"]
+    wanted = set(m.metric for m in metrics)
+    grouped = dict((metric, []) for metric in wanted)
+
+    for key, value in stats.items():
+        prefix, sep, stat = key.rpartition(":")
+
+        if sep and stat in wanted:
+            bucket, sep, index = prefix.partition(":")
+            grouped[stat].append((bucket, index, value))
+
+    for m in metrics:
+        if m.metric == "percent_memory_used":
+            if stats.get("memory_quota"):
+                value = stats.get("memory_used", 0) / (stats["memory_quota"] * 1.0) * 100
+                results.append(Result(host, "index", m, value))
+        elif grouped[m.metric] and m.aggregate == "bucket":
+            totals = collections.OrderedDict()
+
+            for bucket, index, value in grouped[m.metric]:
+                totals[bucket] = totals.get(bucket, 0) + value
+
+            for bucket, value in totals.items():
+                results.append(Result(host, "index {0}".format(bucket), m, value))
+        elif grouped[m.metric]:
+            for bucket, index, value in grouped[m.metric]:
+                results.append(Result(host, "index {0}:{1}".format(bucket, index), m, value))
+        elif m.metric in stats:
+            results.append(Result(host, "index", m, stats[m.metric]))
+        else:
+            logging.debug("Index stat does not exist: {0}".format(m.metric))
+
+    return results
+
+
+# Evaluates node stats and sends check results, a metric may be the dotted path
+# of a nested stat such as interestingStats.curr_items. Numbers are kept as
+# numbers so they can be derived, other values are compared as strings
 def process_node_stats(host, stats, config, results):
     logging.debug("Processing Nodes Stats...{}".format(host))
-    metrics = config["node"]
+    metrics = config["rules"].get("node", ())
 
     for m in metrics:
-        if validate_metric(m, stats) is False:
+        if m.metric is not None and "." in m.metric:
+            value = get_stat(stats, m.metric)
+
+            if value is None:
+                logging.debug("Node stat does not exist: {0}".format(m.metric))
+                continue
+        elif validate_metric(m, stats) is False:
             continue
+        else:
+            value = stats[m.metric]
 
-        value = str(stats[m["metric"]])
+        if not isinstance(value, numbers.Number) or isinstance(value, bool):
+            value = str(value)
 
-        results.append({"host": host, "metric": m, "value": value, "label": "node"})
+        results.append(Result(host, "node", m, value))
 
     return results
 
 
-# Executes a Couchbase REST API request and returns the output
+# Returns the stat at the dotted path in nested stats, or None
+def get_stat(stats, path):
+    value = stats
+
+    for key in (path or "").split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+
+    return value
+
+
+# Returns the memory mapped history file of a series, the file is created, or
+# recreated when history_size changed, with room for history_size records
+def get_history(key, config):
+    name = re.sub(r"[^\w.-]", "_", "_".join(key))
+    digest = hashlib.sha1("\0".join(key).encode("utf-8")).hexdigest()[:8]
+    path = os.path.join(config["history_dir"], "{0}-{1}.ring".format(name, digest))
+    history = history_maps.get(path)
+
+    if history is None:
+        size = history_header.size + history_record.size * max(1, config["history_size"])
+
+        if not os.path.isdir(config["history_dir"]):
+            os.makedirs(config["history_dir"])
+
+        with open(path, "a+b") as f:
+            if os.fstat(f.fileno()).st_size != size:
+                f.truncate(0)
+                f.truncate(size)
+
+            history = history_maps[path] = mmap.mmap(f.fileno(), size)
+
+    return history
+
+
+# Writes a record over the oldest one, the write is O(1) and the file size fixed
+def append_history(history, timestamp, value):
+    count = history_header.unpack_from(history, 0)[0]
+    capacity = (len(history) - history_header.size) // history_record.size
+
+    history_record.pack_into(history, history_header.size + count % capacity * history_record.size, timestamp, value)
+    history_header.pack_into(history, 0, count + 1)
+
+
+# Reads the latest n records, oldest first
+def read_history(history, n):
+    count = history_header.unpack_from(history, 0)[0]
+    capacity = (len(history) - history_header.size) // history_record.size
+
+    return [history_record.unpack_from(history, history_header.size + i % capacity * history_record.size)
+            for i in range(count - min(n, count, capacity), count)]
+
+
+# Derives a value from the records of a series: the rate per second and delta
+# between the first and last record, the moving average, or the least squares
+# slope per second. Returns None until the window of the rule is filled.
+def derive_value(rule, records):
+    values = [value for timestamp, value in records]
+
+    if not values or len(records) < rule.window:
+        return None
+
+    if rule.type == "avg":
+        return avg(values)
+
+    if len(records) < 2 or records[-1][0] <= records[0][0]:
+        return None
+
+    if rule.type == "delta":
+        return values[-1] - values[0]
+
+    times = [timestamp - records[0][0] for timestamp, value in records]
+
+    if rule.type == "rate":
+        return (values[-1] - values[0]) / times[-1]
+
+    mean_time, mean_value = avg(times), avg(values)
+    return sum((t - mean_time) * (v - mean_value) for t, v in zip(times, values)) / sum((t - mean_time) ** 2 for t in times)
+
+
+# Records the result of a derived metric in the history of its series, keyed by
+# host, label and metric name, and returns it with the derived value. Returns
+# None until the series has enough history.
+def derive_result(result, config):
+    rule = result.rule
+
+    if not isinstance(result.value, numbers.Number):
+        logging.warning("Skipped: {0} of non numeric metric: {1}".format(rule.type, rule.metric))
+        return None
+
+    try:
+        history = get_history((result.host, result.label, rule.name), config)
+        append_history(history, time.time(), result.value)
+        value = derive_value(rule, read_history(history, rule.window))
+    except (OSError, IOError, ValueError) as e:
+        logging.error("Failed to update history of {0}: {1}".format(rule.name, str(e)))
+        return None
+
+    if value is None:
+        logging.debug("Not enough history for {0} {1} {2}".format(result.host, result.label, rule.name))
+        return None
+
+    return result._replace(value=value)
+
+
+# Returns the thread pool requests run in, the session's connection pool is
+# shared by its threads
+def get_executor(config):
+    global executor
+
+    if executor is None:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, config["max_workers"]))
+
+    return executor
+
+
+# Returns the HTTP session shared by all requests, connections are pooled per
+# host and kept alive so https handshakes are paid once per host
+def get_session(config):
+    global session
+
+    if session is None:
+        requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+
+        retries = requests.packages.urllib3.util.retry.Retry(total=config["retries"], backoff_factor=config["backoff"], status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=config["pool_hosts"], pool_maxsize=config["pool_size"], max_retries=retries)
+
+        session = requests.Session()
+        session.auth = (config["username"], config["password"])
+        session.verify = False
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+    return session
+
+
+# Returns the (connect, read) timeout for a service, falls back to the cluster
+# timeout and then --timeout
+def get_timeout(config, service=None):
+    timeouts = config.get("timeouts") or {}
+    timeout = timeouts.get(service)
+
+    if timeout is None:
+        timeout = timeouts.get("cluster")
+
+    if timeout is None:
+        timeout = config["timeout"]
+
+    return (config["connect_timeout"], timeout)
+
+
+# Returns the response of a Couchbase REST API request. Responses are reused for
+# --cache-ttl seconds, at most --cache-size of them with the least recently used
+# evicted first, and concurrent requests of the same uri share one request.
+# Failed requests are not cached.
 def couchbase_request(host, port, uri, config, service=None):
+    key = (host, str(port), uri)
+
+    with response_lock:
+        cached = response_cache.get(key)
+
+        if cached is not None and cached[0] > time.time():
+            response_cache.move_to_end(key)
+            response_counts["hits"] += 1
+            return cached[1]
+
+        future = inflight_requests.get(key)
+        owner = future is None
+
+        if owner:
+            future = inflight_requests[key] = concurrent.futures.Future()
+            response_counts["misses"] += 1
+        else:
+            response_counts["coalesced"] += 1
+
+    # another thread is making the same request, share its response
+    if not owner:
+        return future.result()
+
+    response = {}
+
+    try:
+        response = get_response(host, port, uri, config, service)
+    finally:
+        with response_lock:
+            del inflight_requests[key]
+
+            if response and config["cache_ttl"] > 0:
+                response_cache[key] = (time.time() + config["cache_ttl"], response)
+                response_cache.move_to_end(key)
+
+                while len(response_cache) > max(0, config["cache_size"]):
+                    response_cache.popitem(last=False)
+
+        future.set_result(response)
+
+    return response
+
+
+# Logs the response cache counters
+def log_response_counts():
+    logging.debug("Response cache: {hits} hits, {misses} misses, {coalesced} coalesced".format(**response_counts))
+
+
+# Executes a Couchbase REST API request and returns the output
+def get_response(host, port, uri, config, service=None):
     url = "{0}://{1}:{2}{3}".format(config["protocol"], host, str(port), uri)
     logging.debug("Attempting Couchbase Request: {}".format(url))
 
     try:
-        requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
-        f = requests.get(url, auth=(config["username"], config["password"]), verify=False, timeout=10)
+        f = get_session(config).get(url, timeout=get_timeout(config, service))
         logging.debug(f)
 
         status = f.status_code
@@ -354,66 +1151,191 @@ def couchbase_request(host, port, uri, config, service=None):
         return {}
 
 
-def formatted_output_list(results, cluster_name, config):
-    lines = []
-    for result in results:
-        host = result["host"]
-        metric = result["metric"]
-        value = result["value"]
-        label = result["label"]
-        
-        metric.setdefault("crit", None)
-        metric.setdefault("warn", None)
-        metric.setdefault("op", ">=")
-        metric.setdefault("metric", None)
-        metric.setdefault("description", None)
-
-        if metric["op"] not in [">", ">=", "=", "<=", "<"]:
-            logging.warning("Skipped metric: \"{0}\", invalid operator: {1}".format(metric["description"], metric["op"]))
-            continue
+# Compact column store of results. Host and label strings are interned into a
+# names table, the rule is stored as an index into the rules table, numeric
+# values are packed into a double array and the status is evaluated on append.
+# Collectors append to a store of their own, so a Result only lives until it is
+# appended. Derived metrics are derived on append, see derive_result().
+class ResultStore(object):
+    __slots__ = ("config", "names", "name_ids", "rules", "rule_ids", "hosts", "labels", "metrics", "values", "texts", "statuses")
+
+    def __init__(self, config=None):
+        self.config = config
+        self.names = []
+        self.name_ids = {}
+        self.rules = []
+        self.rule_ids = {}
+        self.hosts = array.array("I")
+        self.labels = array.array("I")
+        self.metrics = array.array("I")
+        self.values = array.array("d")
+        self.texts = {}
+        self.statuses = array.array("b")
+
+    def __len__(self):
+        return len(self.statuses)
+
+    def intern(self, name):
+        name_id = self.name_ids.get(name)
+
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(sys.intern(name))
+
+        return name_id
+
+    # rules are immutable and live as long as the config, key them by identity
+    def rule_id(self, rule):
+        rule_id = self.rule_ids.get(id(rule))
+
+        if rule_id is None:
+            rule_id = self.rule_ids[id(rule)] = len(self.rules)
+            self.rules.append(rule)
+
+        return rule_id
+
+    def append(self, result):
+        if result.rule.type != "value":
+            result = derive_result(result, self.config)
+
+            if result is None:
+                return
+
+        rule = result.rule
+        value = result.value
+        rule_id = self.rule_id(rule)
 
         if isinstance(value, numbers.Number):
             value = pretty_number(value)
+            self.values.append(value)
+        else:
+            # non numeric values, such as node status, are kept by row
+            self.texts[len(self.statuses)] = value
+            self.values.append(float("nan"))
+
+        self.hosts.append(self.intern(result.host))
+        self.labels.append(self.intern(result.label))
+        self.metrics.append(rule_id)
+        self.statuses.append(eval_status(value, rule)[0])
+
+    def extend(self, results):
+        for result in results:
+            self.append(result)
 
-        status, status_text = eval_status(value, metric["crit"], metric["warn"], metric["op"])
+    # Appends the rows of another store, the columns are copied with the names
+    # and rules mapped to this store's tables, values are not derived again
+    def merge(self, other):
+        names = [self.intern(name) for name in other.names]
+        rules = [self.rule_id(rule) for rule in other.rules]
+        offset = len(self)
 
-        items = {"host": host}
-        items["cluster_name"] = cluster_name
-        items["label"] = label
-        items["value"] = value
-        items["metric"] = metric["metric"]
-        items["warn"] = metric["warn"]
-        items["crit"] = metric["crit"]
-        items["op"] = metric["op"]
-        items["description"] = metric["description"]
-        items["status"] = status_text
+        self.hosts.extend(names[name_id] for name_id in other.hosts)
+        self.labels.extend(names[name_id] for name_id in other.labels)
+        self.metrics.extend(rules[rule_id] for rule_id in other.metrics)
+        self.values.extend(other.values)
+        self.statuses.extend(other.statuses)
 
-        lines.append(config["format"].format(**items))
-    return lines
+        for row, text in other.texts.items():
+            self.texts[offset + row] = text
+
+    # Yields the (host, label, rule, value, status) of each result in order
+    def rows(self):
+        names, rules, texts = self.names, self.rules, self.texts
+
+        for row in range(len(self)):
+            value = texts[row] if row in texts else pretty_number(self.values[row])
+            yield names[self.hosts[row]], names[self.labels[row]], rules[self.metrics[row]], value, self.statuses[row]
+
+
+# Yields the (status, line) of each result
+def formatted_output_list(results, cluster_name, config):
+    for host, label, rule, value, status in results.rows():
+        line = config["format"].format(host=host, cluster_name=cluster_name, label=label, value=value,
+                                       metric=rule.name, warn=rule.warn, crit=rule.crit, op=rule.op,
+                                       description=rule.description, status=status_texts[status])
+
+        yield status, line
+
+
+def send_results(results, cluster_name, config):
+    if config["file"]:
+        send_file(results, cluster_name, config)
+    else:
+        send_stdout(results, cluster_name, config)
 
 
 def send_stdout(results, cluster_name, config):
-    lines = formatted_output_list(results, cluster_name, config)
-    for line in lines:
+    for status, line in formatted_output_list(results, cluster_name, config):
         print(line)
 
 
-def send_file(results, cluster_name, config):
-    lines = formatted_output_list(results, cluster_name, config)
-    # [logging.info(line) for line in lines]
-    for line in lines:
-        if re.search("CRITICAL", line):
-            logging.critical(line)
-        elif re.search("WARNING", line):
-            logging.warning(line)
+# Escapes an OpenMetrics label value
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# Renders results in OpenMetrics text format. Numeric values are samples of
+# couchbase_check_value, the status of every result of couchbase_check_status
+# and text values, such as node status, of the couchbase_check_text info metric
+def formatted_openmetrics(results, cluster_name, collected):
+    values = []
+    statuses = []
+    texts = []
+
+    for host, label, rule, value, status in results.rows():
+        labels = 'cluster="{0}",host="{1}",label="{2}",metric="{3}",description="{4}"'.format(
+            escape_label(cluster_name), escape_label(host), escape_label(label), escape_label(rule.name), escape_label(rule.description or ""))
+
+        statuses.append("couchbase_check_status{{{0}}} {1}".format(labels, status))
+
+        if isinstance(value, numbers.Number):
+            values.append("couchbase_check_value{{{0}}} {1}".format(labels, value))
         else:
-            logging.info(line)
+            texts.append('couchbase_check_text_info{{{0},value="{1}"}} 1'.format(labels, escape_label(value)))
+
+    lines = ["# TYPE couchbase_check_value gauge",
+             "# HELP couchbase_check_value The value of a check"] + values
+    lines += ["# TYPE couchbase_check_status gauge",
+              "# HELP couchbase_check_status The status of a check, 0 OK, 1 WARNING, 2 CRITICAL"] + statuses
+    lines += ["# TYPE couchbase_check_text info",
+              "# HELP couchbase_check_text The text value of a check"] + texts
+    lines += ["# TYPE couchbase_check_last_collection_timestamp_seconds gauge",
+              "# HELP couchbase_check_last_collection_timestamp_seconds The time the results were collected",
+              "couchbase_check_last_collection_timestamp_seconds {0}".format(collected),
+              "# EOF"]
+
+    return "\n".join(lines) + "\n"
+
+
+# Renders the results once per collection into the cache scrapes are served from
+def send_exporter(results, cluster_name, config):
+    global exporter_cache
 
+    collected = time.time()
+    exporter_cache = (collected, formatted_openmetrics(results, cluster_name, collected))
+
+
+# lines are rendered, logged and written one at a time straight from the store
+def send_file(results, cluster_name, config):
+    # write to a temporary file and rename it so readers never see a partial report
     try:
-        with open(config["file"], 'w') as file:
-            file.writelines(line + '\n' for line in lines)
+        file = open(config["file"] + ".tmp", 'w')
     except Exception as e:
         logging.error(str(e))
+        file = None
+
+    for status, line in formatted_output_list(results, cluster_name, config):
+        logging.log(status_levels[status], line)
+
+        if file is not None:
+            file.write(line + '\n')
+
+    if file is not None:
+        try:
+            file.close()
+            os.rename(config["file"] + ".tmp", config["file"])
+        except Exception as e:
+            logging.error(str(e))
 
 
 def get_node():
@@ -534,6 +1456,22 @@ def get_xdcr():
     return {"xdcr": xdcr}
 
 
+# collection interval in seconds per registered service when running with --daemon
+def get_intervals():
+    intervals = dict((service.name, service.interval) for service in service_registry.values())
+
+    return {"intervals": intervals}
+
+
+# read timeouts in seconds per registered service, null uses the cluster timeout.
+# node stats come with /pools/default, which uses the cluster timeout
+def get_timeouts():
+    timeouts = {"cluster": None}
+    timeouts.update((service.name, None) for service in service_registry.values() if service.node_service is not None)
+
+    return {"timeouts": timeouts}
+
+
 # logging default configuration to console
 def get_logging():
     config = {
@@ -3,6 +3,9 @@
 import os
 import sys
 import argparse
+import concurrent.futures
+import fcntl
+import hashlib
 import yaml
 import logging
 import logging.config
@@ -14,19 +17,31 @@ from datetime import datetime, timedelta
 
 parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 parser.add_argument("--all",  dest="all", action="store_true", default=False, help="Return results for all nodes in the cluster")
+parser.add_argument("--backoff",  dest="backoff", action="store", type=float, default=0.5, help="The backoff factor in seconds between request retries")
 parser.add_argument("--cluster",  dest="cluster", action="store", default="localhost", help="The hostname of the Couchbase cluster")
 parser.add_argument("--config",  dest="config", action="store", help="The path to YAML config file, reading config file overrides args default values")
+parser.add_argument("--connect-timeout",  dest="connect_timeout", action="store", type=float, default=5, help="The number of seconds to wait for a connection to the cluster")
 parser.add_argument("--dump",  dest="dump", action="store_true", default=False, help="Dump the configuration values")
 parser.add_argument("--file",  dest="file", action="store", help="The file to write results to")
 parser.add_argument("--format",  dest="format", action="store", default="{host}:{cluster_name}:{alert}:{status}", help="The format in which to print results. The str of str.format()")
+parser.add_argument("--max-workers",  dest="max_workers", action="store", type=int, default=8, help="The maximum number of nodes to collect logs from concurrently")
 parser.add_argument("--minutes",  dest="minutes", action="store", type=int, default=5, help="The number of minutes to search back")
 parser.add_argument("--password",  dest="password", action="store", default="secret", help="The password of the Couchbase cluster")
 parser.add_argument("--port",  dest="port", action="store", type=int, choices=[8091, 18091], default=8091, help="The port of the Couchbase cluster")
 parser.add_argument("--protocol",  dest="protocol", action="store", choices=["http", "https"], default="http", help="The protocol of the Couchbase cluster")
+parser.add_argument("--retries",  dest="retries", action="store", type=int, default=2, help="The number of times a failed request is retried")
+parser.add_argument("--state",  dest="state", action="store", help="The file to keep the last seen event of each node in, searches start from there instead of --minutes")
+parser.add_argument("--timeout",  dest="timeout", action="store", type=float, default=30, help="The number of seconds to wait for a response from the cluster")
 parser.add_argument("--username",  dest="username", action="store", default="readonly", help="The username of the Couchbase cluster")
 parser.add_argument("--verbose",  dest="verbose", action="store_true", default=False, help="Enable debugging logging")
 args = parser.parse_args()
 
+# HTTP session shared by all requests, see get_session()
+session = None
+
+# lock on the state file held from load_state() to save_state()
+state_lock = None
+
 def get_config():
     config = vars(args)
     config.update(get_alerts())
@@ -151,14 +166,32 @@ def get_logging():
     return {"logging": config}
 
 
+# return the http session shared by all requests, connections are kept alive
+def get_session(config):
+    global session
+
+    if session is None:
+        requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+
+        retries = requests.packages.urllib3.util.retry.Retry(total=config["retries"], backoff_factor=config["backoff"], status_forcelist=[502, 503, 504], raise_on_status=False)
+        adapter = requests.adapters.HTTPAdapter(max_retries=retries)
+
+        session = requests.Session()
+        session.auth = (config["username"], config["password"])
+        session.verify = False
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+    return session
+
+
 # Executes a Couchbase REST API request and returns the output
 def couchbase_request(host, port, uri, config):
     url = "{0}://{1}:{2}{3}".format(config["protocol"], host, str(port), uri)
     logging.debug("attempting couchbase request: {}".format(url))
 
     try:
-        requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
-        f = requests.get(url, auth=(config["username"], config["password"]), verify=False)
+        f = get_session(config).get(url, timeout=(config["connect_timeout"], config["timeout"]))
         logging.debug(f)
 
         status = f.status_code
@@ -181,39 +214,256 @@ def couchbase_request(host, port, uri, config):
         return {}
 
 
-# retrieve and process log events
-def process_node_logs(host, port, cluster_name, config, results):
-    tstamp = int((datetime.now() - timedelta(minutes=config["minutes"])).strftime("%s")) * 1000
-
-    response = couchbase_request(host, port, "/logs", config)
-
-    # validate response contains list
-    if "list" in response:
-        # number of items retureds from request
-        logging.info("{} events returned from {}".format(len(response["list"]), host))
-
-        # filter response data to events that happend minutes ago
-        logging.info("looking for events with timestamp greater than {} milliseconds epoch".format(tstamp))
-        events = [x for x in response["list"] if x["tstamp"] > tstamp]
-        
-        logging.info("{} events with greater timestamp".format(len(events)))
-
-        # dump all the events to log
-        for event in events:
-            logging.debug("event: {}".format(json.dumps(event, indent=4, sort_keys=True)))
-
-        # cycle through configered alerts and search each filtered event
-        for alert in config["alerts"]:
-            logging.debug("searching events for text: {}".format(alert["text"]))
-            status = "OK"
-            for event in events:
-                if re.search(alert["text"], event["text"], flags=re.IGNORECASE):
-                    logging.debug("match found for event: {}".format(json.dumps(event, indent=4, sort_keys=True)))
-                    status = "CRITICAL"
-                        
-            results.append({"host": host, "cluster_name": cluster_name, "alert": alert["name"], "status": status})
-    else:
-        results.append({"host": host, "cluster_name": cluster_name, "alert": "failed to complete request to node", "status": "CRITICAL"})
+# return the longest run of literal text every match of pattern must contain,
+# lower cased, or "" when there is none. only text outside groups, classes and
+# repeats counts, so the fragment can be missing but is never wrong.
+def literal_fragment(pattern):
+    if re.compile(pattern).flags & re.VERBOSE:
+        return ""
+
+    runs = [""]
+    depth = 0
+    index = 0
+
+    while index < len(pattern):
+        char = pattern[index]
+
+        if char == "\\":
+            # escapes may be classes such as \d, skip them
+            runs.append("")
+            index += 2
+            continue
+
+        if char == "[":
+            # skip the character class, a leading ] is part of the class
+            index += 2 if pattern[index + 1:index + 2] == "^" else 1
+            index += 1 if pattern[index:index + 1] == "]" else 0
+
+            while index < len(pattern) and pattern[index] != "]":
+                index += 2 if pattern[index] == "\\" else 1
+
+            runs.append("")
+        elif char == "|" and depth == 0:
+            return ""
+        elif char in "({)":
+            depth += 1 if char == "(" else -1 if char == ")" else 0
+
+            # a repeat makes the character before it optional, skip its bounds
+            if char == "{":
+                if runs[-1]:
+                    runs[-1] = runs[-1][:-1]
+
+                bounds = re.match(r"\{\d*,?\d*\}", pattern[index:])
+                index += len(bounds.group(0)) - 1 if bounds else 0
+
+            runs.append("")
+        elif char in ".^$*+?":
+            if char in "*?" and runs[-1]:
+                runs[-1] = runs[-1][:-1]
+            runs.append("")
+        elif depth == 0:
+            runs[-1] += char
+
+        index += 1
+
+    fragment = max(runs, key=len)
+    return fragment.lower() if len(fragment) >= 3 else ""
+
+
+# compile the alert patterns once. each alert has a literal fragment that is
+# checked with a substring search first, only events containing it are searched
+# with the full pattern. returns [(alert, fragment, pattern)]
+def compile_alerts(alerts):
+    matcher = []
+
+    for alert in alerts:
+        try:
+            matcher.append((alert, literal_fragment(alert["text"]), re.compile(alert["text"], flags=re.IGNORECASE)))
+        except re.error as e:
+            logging.error("invalid alert text for {}: {}".format(alert["name"], str(e)))
+            sys.exit(1)
+
+    return matcher
+
+
+# classify an event against all alerts in one pass, counting matches and the
+# first and last matching timestamp per alert in matches
+def match_event(event, matcher, matches):
+    text = event["text"]
+    lowered = text.lower()
+
+    for index, (alert, fragment, pattern) in enumerate(matcher):
+        if fragment in lowered and pattern.search(text):
+            logging.debug("match found for {}: {}".format(alert["name"], json.dumps(event, indent=4, sort_keys=True)))
+            match = matches[index]
+            match["count"] += 1
+            match["first"] = event["tstamp"] if match["first"] == "" else min(match["first"], event["tstamp"])
+            match["last"] = event["tstamp"] if match["last"] == "" else max(match["last"], event["tstamp"])
+
+
+# executes a streaming couchbase rest api request and returns the open response
+def couchbase_stream(host, port, uri, config):
+    url = "{0}://{1}:{2}{3}".format(config["protocol"], host, str(port), uri)
+    logging.debug("attempting couchbase stream request: {}".format(url))
+
+    f = get_session(config).get(url, timeout=(config["connect_timeout"], config["timeout"]), stream=True)
+    logging.debug(f)
+
+    if f.status_code != 200:
+        f.close()
+        f.raise_for_status()
+
+    return f
+
+
+# yield the events of a /logs response as they are parsed from the stream, only
+# the current chunk and the partial event at its end are held in memory
+def iter_log_events(response):
+    decoder = json.JSONDecoder()
+    buf = ""
+    pos = 0
+    started = False
+
+    if response.encoding is None:
+        response.encoding = "utf-8"
+
+    for chunk in response.iter_content(chunk_size=65536, decode_unicode=True):
+        buf = buf[pos:] + chunk
+        pos = 0
+
+        # skip ahead to the start of the list of events
+        if not started:
+            key = buf.find('"list"')
+            start = buf.find("[", key) if key >= 0 else -1
+
+            if start < 0:
+                continue
+
+            pos = start + 1
+            started = True
+
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+
+            if pos >= len(buf):
+                break
+
+            if buf[pos] == "]":
+                return
+
+            # an incomplete event at the end of the chunk waits for the next chunk
+            try:
+                event, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break
+
+            yield event
+
+    raise ValueError("incomplete list of events in response")
+
+
+# return the key that tells events with the same timestamp apart
+def event_key(event):
+    text = "{0}:{1}:{2}".format(event.get("module"), event.get("code"), event.get("text"))
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+# load the last seen event of each node, the lock is held until the state is
+# saved so overlapping runs don't process the same events
+def load_state(config):
+    global state_lock
+
+    if not config["state"]:
+        return {}
+
+    state_lock = open(config["state"] + ".lock", "w")
+    fcntl.flock(state_lock, fcntl.LOCK_EX)
+
+    try:
+        with open(config["state"], "r") as f:
+            return json.load(f)
+    except IOError:
+        logging.info("no state file {}, searching back {} minutes".format(config["state"], config["minutes"]))
+    except ValueError:
+        logging.error("invalid state file {}, searching back {} minutes".format(config["state"], config["minutes"]))
+
+    return {}
+
+
+# save the last seen event of each node and release the lock
+def save_state(state, config):
+    if not config["state"]:
+        return
+
+    try:
+        with open(config["state"] + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.rename(config["state"] + ".tmp", config["state"])
+    except Exception as e:
+        logging.error(str(e))
+
+    state_lock.close()
+
+
+# retrieve and process log events newer than the node's cursor
+def process_node_logs(host, port, cluster_name, config, results, state, matcher):
+    # the cursor is the newest timestamp seen and the keys of the events at it
+    cursor = state.get(host, {"tstamp": int((datetime.now() - timedelta(minutes=config["minutes"])).strftime("%s")) * 1000, "keys": []})
+    seen = set(cursor["keys"])
+    newest = {"tstamp": cursor["tstamp"], "keys": list(cursor["keys"])}
+
+    logging.info("looking for events from {} with timestamp greater than {} milliseconds epoch".format(host, cursor["tstamp"]))
+
+    matches = [{"count": 0, "first": "", "last": ""} for alert in matcher]
+    count = 0
+    new = 0
+    previous = None
+    descending = None
+
+    try:
+        response = couchbase_stream(host, port, "/logs", config)
+
+        with response:
+            for event in iter_log_events(response):
+                count += 1
+
+                # stopping early is only safe once a strictly decreasing pair of
+                # events has shown the list is newest first, events at the same
+                # timestamp don't tell the order
+                if previous is not None and event["tstamp"] != previous and descending is not False:
+                    descending = event["tstamp"] < previous
+                previous = event["tstamp"]
+
+                if event["tstamp"] < cursor["tstamp"] or (event["tstamp"] == cursor["tstamp"] and event_key(event) in seen):
+                    if descending:
+                        logging.debug("reached already seen events from {}".format(host))
+                        break
+                    continue
+
+                new += 1
+                logging.debug("event: {}".format(json.dumps(event, indent=4, sort_keys=True)))
+
+                # classify the event against all configured alerts in one pass
+                match_event(event, matcher, matches)
+
+                if event["tstamp"] > newest["tstamp"]:
+                    newest = {"tstamp": event["tstamp"], "keys": [event_key(event)]}
+                elif event["tstamp"] == newest["tstamp"]:
+                    newest["keys"].append(event_key(event))
+    except Exception as e:
+        logging.error("failed to complete request to couchbase: {}".format(str(e)))
+        results.append({"host": host, "cluster_name": cluster_name, "alert": "node unreachable", "status": "CRITICAL", "count": 0, "first": "", "last": ""})
+        return results
+
+    # number of items parsed from request
+    logging.info("{} events parsed from {}, {} new".format(count, host, new))
+
+    for (alert, fragment, pattern), match in zip(matcher, matches):
+        status = "CRITICAL" if match["count"] > 0 else "OK"
+        results.append({"host": host, "cluster_name": cluster_name, "alert": alert["name"], "status": status, "count": match["count"], "first": match["first"], "last": match["last"]})
+
+    state[host] = newest
     return results
 
 
@@ -253,6 +503,9 @@ def main():
         print(yaml.dump(config, default_flow_style = False))
         sys.exit(0)
 
+    matcher = compile_alerts(config["alerts"])
+    state = load_state(config)
+
     # retrieve info on cluster
     pools_default = couchbase_request(config["cluster"], config["port"], "/pools/default", config)
 
@@ -262,6 +515,7 @@ def main():
     # retrieve all nodes of cluster
     nodes = pools_default.get("nodes", [{"thisNode": True}])
 
+    hosts = []
     for node in nodes:
         if config["all"] is False and "thisNode" not in node:
             continue
@@ -271,9 +525,19 @@ def main():
         else:
             # node is formatted a hostname:port
             host, port = node["hostname"].split(":")
-        
-        # query and check for log events
-        results = process_node_logs(host, port, cluster_name, config, results)
+
+        hosts.append((host, port))
+
+    # query and check for log events of the nodes concurrently, an unreachable
+    # node reports CRITICAL without holding up the others
+    get_session(config)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, config["max_workers"])) as executor:
+        futures = [executor.submit(process_node_logs, host, port, cluster_name, config, [], state, matcher) for host, port in hosts]
+
+        for future in futures:
+            results.extend(future.result())
+
+    save_state(state, config)
 
     if config["file"]:
         send_file(results, config)
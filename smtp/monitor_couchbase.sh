@@ -6,6 +6,7 @@ TO="couchbase@rackspace.com"
 FROM="couchbase@rackspace.com"
 MINUTES=5
 CHECK=false
+REPORT=false
 LOGWATCH=false
 BACKUP=false
 DIR="/var/log/couchbase"
@@ -19,7 +20,7 @@ function is_int() {
 
 # show usage
 function show_usage() {
-    echo "usage $(basename $0) [-t <to>] [-f <from>] [-s <severity>] [-m <minutes>] [-n <hostname>] [-i <ip addr>] [-c check] [-l logwatch] [-b backup] [-d <directory>] FILE";
+    echo "usage $(basename $0) [-t <to>] [-f <from>] [-s <severity>] [-m <minutes>] [-n <hostname>] [-i <ip addr>] [-c check] [-r report] [-l logwatch] [-b backup] [-d <directory>] FILE";
     echo "run and look for critical, unsuccessful, or true in couchbase monitor script outputs, then send email with output if found"
     echo "-h help"
     echo "-t send email to"
@@ -29,6 +30,7 @@ function show_usage() {
     echo "-n host name"
     echo "-i host ip"
     echo "-c run check_couchbase.py"
+    echo "-r check the report of check_couchbase.py --daemon without running it"
     echo "-l run logwatch_couchbase.py"
     echo "-b run backup_couchbase.py"
     echo "-d directory to search for FILE"
@@ -71,7 +73,7 @@ function tag_file() {
 }
 
 # parse options
-while getopts ":t:f:s:m:d:i:n:clb" OPT; do
+while getopts ":t:f:s:m:d:i:n:crlb" OPT; do
     case $OPT in
         t)
             TO=$OPTARG
@@ -106,6 +108,10 @@ while getopts ":t:f:s:m:d:i:n:clb" OPT; do
             CHECK=true
             ;;
 
+        r)
+            REPORT=true
+            ;;
+
         l)
             LOGWATCH=true
             ;;
@@ -144,6 +150,14 @@ then
     exit 0
 fi
 
+# the daemon rewrites the report after every collection, it is only checked
+if [ $REPORT == 'true' ]
+then
+    tag_file $VAR1 "check"
+    grep_file $VAR1
+    exit 0
+fi
+
 if [ $LOGWATCH == 'true' ]
 then
     echo "/opt/couchbase/scripts/logwatch_couchbase.py --config /opt/couchbase/scripts/logwatch_couchbase.yaml"
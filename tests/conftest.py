@@ -0,0 +1,22 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# the scripts parse their arguments on import, load a fresh copy of a script
+# with the given command line so module state doesn't leak between tests
+@pytest.fixture
+def load_script(monkeypatch):
+    def load(path, *argv):
+        path = os.path.join(root, path)
+        monkeypatch.setattr(sys, "argv", [path] + list(argv))
+        spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    return load
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+fake_cbbackupmgr = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_cbbackupmgr")
+
+
+# write a backup directory holding size bytes to the repo
+def make_backup(repo, name, size=1000):
+    path = os.path.join(repo, name, "default-0123456789abcdef0123456789abcdef", "data")
+    os.makedirs(path)
+    with open(os.path.join(path, "shard_0.sqlite.0"), "wb") as f:
+        f.write(b"x" * size)
+
+
+@pytest.fixture
+def backup(load_script):
+    return load_script("backup/backup_couchbase.py")
+
+
+@pytest.fixture
+def config(backup, tmp_path):
+    config = backup.get_config()
+    config.update(archive=str(tmp_path), repo="repo", cbbackupmgr=fake_cbbackupmgr)
+    os.makedirs(os.path.join(str(tmp_path), "repo"))
+    return config
+
+
+def test_purge_then_compact(backup, config):
+    repo = os.path.join(config["archive"], config["repo"])
+    make_backup(repo, "2020-01-01T00_00_00.000000000-00_00")
+    make_backup(repo, "2020-01-02T00_00_00.000000000-00_00")
+    config["purge"] = True
+
+    state = {}
+    backup.backup(config, state)
+
+    # the purged backup is gone from the state, the new backup is in it
+    assert "2020-01-02T00_00_00.000000000-00_00" not in state["backups"]
+    assert state["backups"] == backup.get_backup_list(config)
+    assert len(state["backups"]) == 2
+
+    backup_result = [x for x in backup.results if x["action"] == "cbbackupmgr backup"][0]
+    assert backup_result["size"] == 1000
+
+    backup.compact(config, state)
+
+    assert sorted(backup.load_ledger(config)) == sorted(state["backups"])
+    assert all(x["status"] == "OK" for x in backup.results)
+
+
+def test_compact_without_rate_is_capped(backup, config, monkeypatch):
+    repo = os.path.join(config["archive"], config["repo"])
+    for day in range(1, 4):
+        make_backup(repo, "2020-01-0{}T00_00_00.000000000-00_00".format(day))
+
+    # compactions too quick to time never give a rate
+    compacted = []
+    monkeypatch.setattr(backup, "run_command", lambda config, action, cmd: compacted.append(cmd[-1]) or {"duration": 0})
+
+    backup.compact(config, {})
+    assert compacted == ["2020-01-03T00_00_00.000000000-00_00"]
+
+    backup.compact(config, {})
+    assert compacted[-1] == "2020-01-02T00_00_00.000000000-00_00"
+    assert len(backup.load_ledger(config)) == 2
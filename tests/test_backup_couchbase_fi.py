@@ -0,0 +1,34 @@
+import os
+
+import pytest
+
+from test_backup_couchbase import make_backup
+
+
+@pytest.fixture
+def backup(load_script):
+    return load_script("backup/backup_couchbase_fi.py")
+
+
+@pytest.fixture
+def config(backup, tmp_path):
+    config = backup.get_config()
+    config.update(archive=str(tmp_path), repo="2020-01-08")
+    return config
+
+
+def test_required_space_is_last_backup(backup, config):
+    repo = os.path.join(config["archive"], config["repo"])
+    make_backup(repo, "2020-01-08T00_00_00.000000000-00_00", 5000)
+    make_backup(repo, "2020-01-09T00_00_00.000000000-00_00", 200)
+
+    assert backup.get_required_space(config) == 200
+
+
+def test_required_space_of_new_repo_is_full_backup(backup, config):
+    repo = os.path.join(config["archive"], "2020-01-01")
+    make_backup(repo, "2020-01-01T00_00_00.000000000-00_00", 5000)
+    make_backup(repo, "2020-01-02T00_00_00.000000000-00_00", 200)
+    os.makedirs(os.path.join(config["archive"], config["repo"]))
+
+    assert backup.get_required_space(config) == 5000
@@ -0,0 +1,80 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def check(load_script):
+    return load_script("check/check_couchbase.py")
+
+
+@pytest.fixture
+def config(check, tmp_path):
+    config = check.get_config()
+    config.update(history_dir=str(tmp_path), history_size=4)
+    return config
+
+
+def get_rule(check, metric_type, window=2):
+    return check.compile_rules([{"metric": "m", "description": "d", "type": metric_type, "window": window, "warn": 1, "crit": 2}])[0]
+
+
+def test_history_wraps_past_capacity(check, config):
+    history = check.get_history(("host", "label", "m_rate"), config)
+    size = len(history)
+
+    for i in range(6):
+        check.append_history(history, i, i * 10)
+
+    # the two oldest records were written over, the rest are read oldest first
+    assert check.read_history(history, 10) == [(2, 20), (3, 30), (4, 40), (5, 50)]
+    assert check.read_history(history, 2) == [(4, 40), (5, 50)]
+    assert len(history) == size
+
+
+def test_history_is_recreated_when_size_changes(check, config):
+    key = ("host", "label", "m_rate")
+    check.append_history(check.get_history(key, config), 1, 10)
+
+    # a new run with another history_size starts the series over
+    check.history_maps.clear()
+    config["history_size"] = 8
+    history = check.get_history(key, config)
+
+    assert check.read_history(history, 8) == []
+    for i in range(8):
+        check.append_history(history, i, i)
+    assert len(check.read_history(history, 8)) == 8
+
+
+def test_derived_values_wait_for_the_window(check):
+    for metric_type in ["rate", "delta", "avg", "slope"]:
+        rule = get_rule(check, metric_type, window=3)
+
+        assert check.derive_value(rule, []) is None
+        assert check.derive_value(rule, [(0, 1), (10, 2)]) is None
+        assert check.derive_value(rule, [(0, 1), (10, 2), (20, 3)]) is not None
+
+
+def test_derived_values(check):
+    records = [(100, 0), (110, 10), (120, 40)]
+
+    assert check.derive_value(get_rule(check, "rate", 3), records) == 2.0
+    assert check.derive_value(get_rule(check, "delta", 3), records) == 40
+    assert check.derive_value(get_rule(check, "avg", 3), records) == pytest.approx(50 / 3.0)
+
+    # least squares through (0, 0), (10, 10), (20, 40)
+    assert check.derive_value(get_rule(check, "slope", 3), records) == pytest.approx(2.0)
+
+
+def test_derive_result_reports_the_rate_once_there_is_history(check, config, monkeypatch):
+    rule = get_rule(check, "rate")
+    values = []
+
+    for now, value in [(1000.0, 5), (1030.0, 65)]:
+        monkeypatch.setattr(check.time, "time", lambda: now)
+        result = check.derive_result(check.Result("host", "label", rule, value), config)
+        values.append(result.value if result else None)
+
+    assert values == [None, 2.0]
+    assert len(os.listdir(config["history_dir"])) == 1
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+
+# a streamed /logs response, the json is handed out in small chunks
+class FakeResponse(object):
+    def __init__(self, events):
+        self.text = json.dumps({"list": events})
+        self.encoding = "utf-8"
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        for start in range(0, len(self.text), 64):
+            yield self.text[start:start + 64]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+@pytest.fixture
+def logwatch(load_script):
+    return load_script("logwatch/logwatch_couchbase.py")
+
+
+# return the count of the disk space alert after processing events newer than cursor
+def count_disk_alerts(logwatch, monkeypatch, events, cursor):
+    monkeypatch.setattr(logwatch, "couchbase_stream", lambda host, port, uri, config: FakeResponse(events))
+    config = logwatch.get_config()
+    state = {"node1": {"tstamp": cursor, "keys": []}}
+
+    results = logwatch.process_node_logs("node1", 8091, "cluster", config, [], state, logwatch.compile_alerts(config["alerts"]))
+    return [x["count"] for x in results if x["alert"].startswith("Disk space used")][0], state
+
+
+def get_events(cursor):
+    old = [{"tstamp": cursor - 2000 + i, "text": "ordinary event {}".format(i), "module": "m", "code": i} for i in range(3)]
+    new = [{"tstamp": cursor + 1000 * (i + 1), "text": "Approaching full disk warning", "module": "m", "code": i} for i in range(5)]
+    return old + new
+
+
+def test_oldest_first_events_are_all_processed(logwatch, monkeypatch):
+    cursor = 1600000000000
+    count, state = count_disk_alerts(logwatch, monkeypatch, get_events(cursor), cursor)
+
+    assert count == 5
+    assert state["node1"]["tstamp"] == cursor + 5000
+
+
+def test_newest_first_events_are_all_processed(logwatch, monkeypatch):
+    cursor = 1600000000000
+    count, state = count_disk_alerts(logwatch, monkeypatch, list(reversed(get_events(cursor))), cursor)
+
+    assert count == 5
+    assert state["node1"]["tstamp"] == cursor + 5000
+
+
+def test_newest_first_stops_at_seen_events(logwatch, monkeypatch):
+    cursor = 1600000000000
+    events = list(reversed(get_events(cursor)))
+
+    # events past the already seen ones aren't even parsed
+    events.append({"tstamp": cursor + 10 ** 6, "text": "Approaching full disk warning", "module": "m", "code": 99})
+    count, state = count_disk_alerts(logwatch, monkeypatch, events, cursor)
+
+    assert count == 5
+
+
+def test_oldest_first_with_tied_leading_events(logwatch, monkeypatch):
+    cursor = 1600000000000
+    events = get_events(cursor)[2:]
+
+    # old events at the same timestamp don't show the list is newest first
+    events.insert(0, dict(events[0], text="ordinary event tied", code=10))
+    count, state = count_disk_alerts(logwatch, monkeypatch, events, cursor)
+
+    assert count == 5
+    assert state["node1"]["tstamp"] == cursor + 5000